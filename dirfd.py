@@ -0,0 +1,227 @@
+"""
+Symlink operations relative to an open directory
+
+Every os call that takes a path looks up each of its components again,
+so rewriting thousands of links in the same deep directories pays for
+the same walk down the same leading directories over and over.  A
+Directory opens its directory once and reads, creates, renames and
+removes the names in it with dir_fd=, so the kernel only looks up the
+last component.  DirCache keeps recently used Directories open for jobs
+that visit links in any order, and relink() rewrites a list of links a
+directory at a time.
+
+The calls go through fsops, and Directory.make_the_move() behaves (and
+invalidates pathcache) like symlink_edit.make_the_move().  Where the
+platform lacks dir_fd support, Directory falls back to full paths.
+"""
+
+import os
+import stat
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fsops
+import pathcache
+
+# (os.replace and os.remove are listed under os.rename and os.unlink)
+HAVE_DIR_FD = {os.stat, os.readlink, os.symlink, os.rename,
+               os.unlink} <= os.supports_dir_fd
+
+_OPEN_FLAGS = (os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) |
+               getattr(os, 'O_CLOEXEC', 0))
+
+
+class Directory(object):
+    """
+    An open directory.  Methods take names relative to it (a relative
+    symlink value works too); absolute paths are used as they are.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.fd = fsops.open(self.path, _OPEN_FLAGS) if HAVE_DIR_FD else None
+        self._realpath = None
+
+    def invalidate(self, name):
+        """ pathcache.invalidate() name, resolving this directory once """
+        if self._realpath is None:
+            self._realpath = pathcache.realpath(self.path)
+        pathcache.invalidate(os.path.join(self.path, name),
+                             realparent=self._realpath)
+
+    def close(self):
+        if self.fd is not None:
+            fsops.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _at(self, name):
+        return name if self.fd is not None else os.path.join(self.path, name)
+
+    def readlink(self, name):
+        return fsops.readlink(self._at(name), dir_fd=self.fd)
+
+    def lstat(self, name):
+        return fsops.stat(self._at(name), dir_fd=self.fd,
+                          follow_symlinks=False)
+
+    def exists(self, name):
+        try:
+            fsops.stat(self._at(name), dir_fd=self.fd)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def lexists(self, name):
+        try:
+            self.lstat(name)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def islink(self, name):
+        try:
+            return stat.S_ISLNK(self.lstat(name).st_mode)
+        except (OSError, ValueError):
+            return False
+
+    def symlink(self, target, name):
+        fsops.symlink(target, self._at(name), dir_fd=self.fd)
+
+    def remove(self, name):
+        fsops.remove(self._at(name), dir_fd=self.fd)
+
+    def rename(self, name, newdir, newname):
+        """ Rename name here to newname in Directory newdir """
+        fsops.rename(self._at(name), newdir._at(newname),
+                     src_dir_fd=self.fd, dst_dir_fd=newdir.fd)
+
+    def replace_symlink(self, target, name):
+        """ symlink_edit.replace_symlink() for name in this directory """
+        while True:
+            tmpname = '.{}.{}.tmp'.format(name, os.urandom(4).hex())
+            try:
+                self.symlink(target, tmpname)
+                break
+            except FileExistsError:
+                continue
+        try:
+            fsops.replace(self._at(tmpname), self._at(name),
+                          src_dir_fd=self.fd, dst_dir_fd=self.fd)
+        except OSError:
+            self.remove(tmpname)
+            raise
+        finally:
+            self.invalidate(name)
+
+    def make_the_move(self, name, newtargetref, allowbroken=False,
+                      savebackup=False):
+        """ symlink_edit.make_the_move() for name in this directory """
+        linkname = os.path.join(self.path, name)
+        target_exists = self.exists(newtargetref)
+        if not (target_exists or allowbroken):
+            raise FileNotFoundError(newtargetref)
+        retval = ""
+        if self.islink(name):
+            if savebackup:
+                self.replace_symlink(self.readlink(name), name + "~")
+                retval += "Backup {}~ saved.\n".format(linkname)
+        elif self.lexists(name):
+            # don't clobber a real file or directory
+            raise FileExistsError(linkname)
+        self.replace_symlink(newtargetref, name)
+        retval += "{} -> {}".format(linkname, newtargetref)
+        if not target_exists:
+            retval += "\nNOTE: {} doesn't appear to exist.".format(
+                newtargetref)
+        return retval
+
+
+class DirCache(object):
+    """
+    Directories by path, keeping up to maxopen of them open (least
+    recently used are closed first).  For use by one thread at a time.
+    """
+
+    def __init__(self, maxopen=64):
+        self.maxopen = maxopen
+        self._dirs = OrderedDict()
+
+    def get(self, path):
+        """ The open Directory for path """
+        path = os.path.abspath(path)
+        try:
+            self._dirs.move_to_end(path)
+            return self._dirs[path]
+        except KeyError:
+            pass
+        directory = self._dirs[path] = Directory(path)
+        if len(self._dirs) > self.maxopen:
+            self._dirs.popitem(last=False)[1].close()
+        return directory
+
+    def split(self, path):
+        """ (the open Directory of path's parent, path's basename) """
+        dirname, name = os.path.split(os.path.abspath(path))
+        return self.get(dirname), name
+
+    def invalidate(self, path):
+        """
+        Close the Directories for path and everything below it.  An
+        open directory follows its inode, so call this after moving a
+        directory that may be open under its old path.
+        """
+        path = os.path.abspath(path)
+        prefix = path.rstrip('/') + '/'
+        for key in [k for k in self._dirs
+                    if k == path or k.startswith(prefix)]:
+            self._dirs.pop(key).close()
+
+    def close(self):
+        while self._dirs:
+            self._dirs.popitem()[1].close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def relink(moves, allowbroken=False, savebackup=False, jobs=1):
+    """
+    make_the_move() every (link, target) pair in moves, opening each
+    link's directory once and giving each directory to one of jobs
+    threads.  Returns a list with, for each move, None or the OSError
+    it failed with.
+    """
+    bydir = OrderedDict()
+    for i, (link, target) in enumerate(moves):
+        dirname, name = os.path.split(os.path.abspath(link))
+        bydir.setdefault(dirname, []).append((i, name, target))
+    errors = [None] * len(moves)
+
+    def relink_dir(item):
+        dirname, entries = item
+        try:
+            directory = Directory(dirname)
+        except OSError as err:
+            for i, name, target in entries:
+                errors[i] = err
+            return
+        with directory:
+            for i, name, target in entries:
+                try:
+                    directory.make_the_move(name, target, allowbroken,
+                                            savebackup)
+                except OSError as err:
+                    errors[i] = err
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        list(executor.map(relink_dir, bydir.items()))
+    return errors
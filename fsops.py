@@ -0,0 +1,166 @@
+"""
+Filesystem calls that can be counted, timed and traced
+
+swapln, symmv and symlink_edit (and pathcache, for the readlinks it
+really makes) call the filesystem through this module instead of os,
+os.path and shutil directly.  Each function here has the same name and
+signature as the one it stands for; call them as fsops.name(...), since
+a name imported with "from fsops import" won't see enable().
+
+Normally these names are bound straight to the os/os.path/shutil
+functions, so using them costs nothing extra.  enable() rebinds them to
+wrappers that count and time every call per operation, and optionally
+append a JSON line per call to a trace file:
+
+    {"op": "replace", "args": ["/tmp/.x.1a2b.tmp", "/tmp/x"],
+     "t": 0.0123, "secs": 0.000021}
+
+("t" is seconds since enable(); failed calls add "error").  report()
+summarizes the counters.  Setting FSOPS_PROFILE=1 or FSOPS_TRACE=file
+in the environment enables this from the start, with a report to
+stderr at exit.
+"""
+
+import atexit
+import io
+import json
+import os
+import os.path
+import shutil
+import sys
+import threading
+import time
+
+# name in this module: the function it stands for
+OPERATIONS = {
+    'open': os.open,
+    'close': os.close,
+    'stat': os.stat,
+    'lstat': os.lstat,
+    'readlink': os.readlink,
+    'symlink': os.symlink,
+    'rename': os.rename,
+    'replace': os.replace,
+    'remove': os.remove,
+    'rmdir': os.rmdir,
+    'mkdir': os.mkdir,
+    'makedirs': os.makedirs,
+    'scandir': os.scandir,
+    'fsync': os.fsync,
+    'exists': os.path.exists,
+    'lexists': os.path.lexists,
+    'isdir': os.path.isdir,
+    'islink': os.path.islink,
+    'getsize': os.path.getsize,
+    'move': shutil.move,
+    'copyfile': shutil.copyfile,
+    'copystat': shutil.copystat,
+    'rmtree': shutil.rmtree,
+}
+if hasattr(os, 'copy_file_range'):
+    OPERATIONS['copy_file_range'] = os.copy_file_range
+
+globals().update(OPERATIONS)
+
+counts = {}
+seconds = {}
+errors = {}
+_lock = threading.Lock()
+_trace = None
+_start = None
+
+
+def _instrument(name, func):
+    perf_counter = time.perf_counter
+
+    def instrumented(*args, **kwargs):
+        start = perf_counter()
+        error = None
+        try:
+            return func(*args, **kwargs)
+        except OSError as err:
+            error = err
+            raise
+        finally:
+            secs = perf_counter() - start
+            with _lock:
+                counts[name] = counts.get(name, 0) + 1
+                seconds[name] = seconds.get(name, 0.0) + secs
+                if error is not None:
+                    errors[name] = errors.get(name, 0) + 1
+                if _trace is not None:
+                    record = {'op': name, 't': round(start - _start, 6),
+                              'secs': round(secs, 6),
+                              'args': [os.fsdecode(arg) for arg in args
+                                       if isinstance(arg, (str, bytes))]}
+                    if error is not None:
+                        record['error'] = error.strerror or str(error)
+                    _trace.write(json.dumps(record) + '\n')
+    instrumented.__name__ = name
+    instrumented.__doc__ = func.__doc__
+    return instrumented
+
+
+def enable(trace=None):
+    """
+    Start counting and timing calls, and if trace is a filename, write
+    a JSON line per call to it.
+    """
+    global _trace, _start
+    with _lock:
+        if trace and _trace is None:
+            # the builtin open is shadowed by os.open here
+            _trace = io.open(trace, 'w')
+        if _start is None:
+            _start = time.perf_counter()
+    globals().update((name, _instrument(name, func))
+                     for name, func in OPERATIONS.items())
+
+
+def disable():
+    """ Go back to the plain functions, closing any trace file """
+    global _trace
+    globals().update(OPERATIONS)
+    with _lock:
+        if _trace is not None:
+            _trace.close()
+            _trace = None
+
+
+def enabled():
+    return globals()['stat'] is not os.stat
+
+
+def report():
+    """ Return a table of calls, errors and time per operation """
+    with _lock:
+        rows = sorted(counts, key=lambda name: -seconds[name])
+        total = sum(seconds.values())
+        lines = ["{:<16} {:>9} {:>7} {:>11} {:>9}".format(
+            'operation', 'calls', 'errors', 'total ms', 'us/call')]
+        for name in rows:
+            lines.append("{:<16} {:>9} {:>7} {:>11.3f} {:>9.1f}".format(
+                name, counts[name], errors.get(name, 0),
+                1e3 * seconds[name], 1e6 * seconds[name] / counts[name]))
+        lines.append("{:<16} {:>9} {:>7} {:>11.3f}".format(
+            'total', sum(counts.values()), sum(errors.values()), 1e3 * total))
+    return '\n'.join(lines)
+
+
+def start(profile=False, trace=None):
+    """
+    For a command's --profile/--trace options: enable() if either is
+    set, and print report() to stderr at exit.
+    """
+    if not (profile or trace):
+        return
+    enable(trace)
+
+    def finish():
+        disable()
+        sys.stderr.write(report() + '\n')
+    atexit.register(finish)
+
+
+if os.getenv('FSOPS_PROFILE') or os.getenv('FSOPS_TRACE'):
+    start(True, os.getenv('FSOPS_TRACE'))
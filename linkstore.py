@@ -0,0 +1,239 @@
+"""
+A compact, read-only in-memory link table
+
+Holding a big link table as a dict of (link, target) strings costs a
+couple of hundred bytes per link, most of it spent on the same
+directory prefixes over and over.  LinkStore interns every path
+component once, keeps every path (link or target) as a node in a
+parent-pointer trie, and stores the trie and the links as flat
+array.array columns, so the per-link cost is a few dozen bytes.
+
+Trie nodes are numbered in preorder with siblings sorted by name, so
+everything below a directory is one contiguous range of node numbers;
+that makes "links to anything under this directory" a range lookup on
+the links sorted by target.  Component names live in one shared bytes
+buffer and each name is just an offset into it.
+
+A LinkStore is built once from (link, target) rows (see
+LinkIndex.iter_table()) and is rebuilt rather than updated.  Paths are
+expected to be absolute and normalized, as they are in the index.
+
+Only lnqueryd.py holds a LinkStore; lnlookup.sh and lnquery.py reach it
+through the daemon's socket.  The one-shot commands ("lnindex.py
+query", "lnshards.py query") stay on SQLite on purpose: building a
+LinkStore reads the whole table, which costs far more than the indexed
+query a single lookup needs.
+"""
+
+import bisect
+import os
+from array import array
+
+# target of a link that didn't resolve
+NONE = 0xffffffff
+
+
+class LinkStore(object):
+    """ Read-only link table: lookup, links_to and links_under """
+
+    def __init__(self, rows=()):
+        names = {b'': 0}
+        parent = array('I', [NONE])
+        nameid = array('I', [0])
+        kids = {}
+        links = array('I')
+        targets = array('I')
+
+        def intern(path):
+            node = 0
+            for name in path.split(b'/'):
+                if not name:
+                    continue
+                nid = names.setdefault(name, len(names))
+                key = (node << 32) | nid
+                child = kids.get(key)
+                if child is None:
+                    child = kids[key] = len(parent)
+                    parent.append(node)
+                    nameid.append(nid)
+                node = child
+            return node
+
+        for link, target in rows:
+            links.append(intern(os.fsencode(link)))
+            targets.append(intern(os.fsencode(target)) if target else NONE)
+        del kids
+
+        # the shared name buffer, with offsets[i]:offsets[i + 1] being
+        # name number i
+        ordered = sorted(names, key=names.get)
+        del names
+        self._offsets = array('I', [0])
+        for name in ordered:
+            self._offsets.append(self._offsets[-1] + len(name))
+        self._buf = b''.join(ordered)
+        del ordered
+
+        old2new = self._renumber(parent, nameid)
+        del parent, nameid
+        links = array('I', (old2new[n] for n in links))
+        targets = array('I', (NONE if n == NONE else old2new[n]
+                              for n in targets))
+        del old2new
+
+        order = sorted(range(len(links)), key=links.__getitem__)
+        self._links = array('I', (links[i] for i in order))
+        self._targets = array('I', (targets[i] for i in order))
+        del links, targets, order
+        # links again, this time ordered by target
+        self._by_target = array('I', sorted(range(len(self._links)),
+                                            key=self._targets.__getitem__))
+        self._target_keys = array('I', (self._targets[i]
+                                        for i in self._by_target))
+
+    def _renumber(self, parent, nameid):
+        """
+        Renumber the trie nodes in preorder with sorted siblings and
+        build the child lists.  Sets _parent, _nameid, _end (one past
+        the last node of each subtree), _kid_start and _kids, and
+        returns the old-to-new node number mapping.
+        """
+        n = len(parent)
+        # counting sort of nodes by parent, to find each node's children
+        start = array('I', bytes(4 * (n + 1)))
+        for node in range(1, n):
+            start[parent[node] + 1] += 1
+        for node in range(n):
+            start[node + 1] += start[node]
+        fill = array('I', start)
+        children = array('I', bytes(4 * n))
+        for node in range(1, n):
+            p = parent[node]
+            children[fill[p]] = node
+            fill[p] += 1
+        del fill
+
+        old2new = array('I', bytes(4 * n))
+        new_parent = array('I', bytes(4 * n))
+        new_nameid = array('I', bytes(4 * n))
+        end = array('I', bytes(4 * n))
+        new_parent[0] = NONE
+        counter = 1
+        # iterative preorder walk, visiting each node's kids by name
+        stack = [(0, iter(self._sorted_kids(children, start, nameid, 0)))]
+        while stack:
+            old, it = stack[-1]
+            child = next(it, None)
+            if child is None:
+                end[old2new[old]] = counter
+                stack.pop()
+                continue
+            old2new[child] = counter
+            new_parent[counter] = old2new[old]
+            new_nameid[counter] = nameid[child]
+            counter += 1
+            stack.append((child, iter(
+                self._sorted_kids(children, start, nameid, child))))
+        del children, start
+
+        # with preorder numbering, each node's children are increasing
+        self._kid_start = array('I', bytes(4 * (n + 1)))
+        for node in range(1, n):
+            self._kid_start[new_parent[node] + 1] += 1
+        for node in range(n):
+            self._kid_start[node + 1] += self._kid_start[node]
+        self._kids = array('I', bytes(4 * n))
+        fill = array('I', self._kid_start)
+        for node in range(1, n):
+            p = new_parent[node]
+            self._kids[fill[p]] = node
+            fill[p] += 1
+        self._parent = new_parent
+        self._nameid = new_nameid
+        self._end = end
+        return old2new
+
+    def _sorted_kids(self, children, start, nameid, node):
+        kids = children[start[node]:start[node + 1]]
+        return sorted(kids, key=lambda k: self._name(nameid[k]))
+
+    def _name(self, nid):
+        return self._buf[self._offsets[nid]:self._offsets[nid + 1]]
+
+    def _path(self, node):
+        if node == NONE:
+            return ''
+        buf, offsets = self._buf, self._offsets
+        nameid, parent = self._nameid, self._parent
+        parts = []
+        while node:
+            nid = nameid[node]
+            parts.append(buf[offsets[nid]:offsets[nid + 1]])
+            node = parent[node]
+        parts.append(b'')
+        return os.fsdecode(b'/'.join(reversed(parts)) or b'/')
+
+    def _find(self, path):
+        """ Return the node for path, or None if it isn't in the trie """
+        node = 0
+        for name in os.fsencode(path).split(b'/'):
+            if not name:
+                continue
+            lo, hi = self._kid_start[node], self._kid_start[node + 1]
+            i = bisect.bisect_left(
+                self._kids, name, lo, hi,
+                key=lambda k: self._name(self._nameid[k]))
+            if i == hi or self._name(self._nameid[self._kids[i]]) != name:
+                return None
+            node = self._kids[i]
+        return node
+
+    def __len__(self):
+        return len(self._links)
+
+    def __iter__(self):
+        """ Yield (link, target) pairs """
+        for node, target in zip(self._links, self._targets):
+            yield self._path(node), self._path(target)
+
+    def nbytes(self):
+        """ Bytes held by the store's arrays and name buffer """
+        arrays = (self._offsets, self._parent, self._nameid, self._end,
+                  self._kid_start, self._kids, self._links, self._targets,
+                  self._by_target, self._target_keys)
+        return len(self._buf) + sum(a.itemsize * len(a) for a in arrays)
+
+    def lookup(self, link):
+        """ Return [(link, target)] if link is in the table, else [] """
+        node = self._find(link)
+        if node is None:
+            return []
+        i = bisect.bisect_left(self._links, node)
+        if i == len(self._links) or self._links[i] != node:
+            return []
+        return [(link, self._path(self._targets[i]))]
+
+    def _by_targets(self, lo, hi):
+        i = bisect.bisect_left(self._target_keys, lo)
+        j = bisect.bisect_left(self._target_keys, hi)
+        rows = []
+        last = None
+        for k in self._by_target[i:j]:
+            if self._targets[k] != last:
+                last = self._targets[k]
+                target = self._path(last)
+            rows.append((self._path(self._links[k]), target))
+        return rows
+
+    def links_to(self, target):
+        """ Return (link, target) for links resolving exactly to target """
+        node = self._find(target)
+        return [] if node is None else self._by_targets(node, node + 1)
+
+    def links_under(self, prefix):
+        """
+        Return (link, target) for links resolving to prefix or anywhere
+        below it, ordered by target.
+        """
+        node = self._find(prefix)
+        return [] if node is None else self._by_targets(node, self._end[node])
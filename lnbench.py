@@ -0,0 +1,990 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the symlinkutil tools
+
+Each subcommand builds (or is pointed at) a tree of symlinks and times
+one of the tools against it.  "suite" times all of them on a generated
+tree and writes JSON, and "compare" diffs two such runs, e.g.
+
+    lnbench.py suite -o before.json
+    (change things)
+    lnbench.py suite -o after.json
+    lnbench.py compare before.json after.json
+
+"atomic" doubles as a check, exiting 1 if readers ever see the link
+missing or wrong, or a swap or backup is lost:
+
+    lnbench.py atomic && lnbench.py atomic --backup
+
+So do "table" (lntable.py against the old find/readlink loop) and
+"suggest" (get_values_from_links() against get_values_from_link()),
+exiting 1 if the outputs differ anywhere:
+
+    lnbench.py table && lnbench.py suggest --dirs 200
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import dirfd
+import fsops
+import linkstore
+import lnindex
+import lnshards
+import lntable
+import pathcache
+import swapln
+import symlink_edit
+import symmv
+
+SHELL_TABLE = ('find "$1" -type l | while read LINE; do '
+               'printf "${LINE}\\t$(readlink -f ${LINE})\\n"; done')
+
+
+def make_tree(root, ndirs=100, nlinks=20, depth=3):
+    """
+    Build a simple synthetic tree under root: ndirs directories spread
+    over depth levels, each holding a file and nlinks symlinks pointing
+    at files elsewhere in the tree.
+    """
+    dirs = []
+    for i in range(ndirs):
+        parts = ['d{}'.format((i // (10 ** level)) % 10)
+                 for level in range(depth - 1, 0, -1)]
+        path = os.path.join(root, *parts, 'leaf{}'.format(i))
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'file'), 'w') as f:
+            f.write(path)
+        dirs.append(path)
+    for i, path in enumerate(dirs):
+        for j in range(nlinks):
+            target = os.path.join(dirs[(i * 7 + j) % len(dirs)], 'file')
+            if j % 2:
+                target = os.path.relpath(target, path)
+            os.symlink(target, os.path.join(path, 'ln{}'.format(j)))
+    return root
+
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def run_shell_table(root):
+    out = subprocess.run(['bash', '-c', SHELL_TABLE, 'bash', root],
+                         stdout=subprocess.PIPE, check=True).stdout
+    return sorted(out.splitlines())
+
+
+def run_lntable(root):
+    return sorted(os.fsencode(link) + b'\t' + os.fsencode(target)
+                  for link, target in lntable.iter_table([root]))
+
+
+def bench_table(args):
+    """ compare lntable.py with the old find/readlink pipeline """
+    root = args.root
+    tmpdir = None
+    if root is None:
+        tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+        root = make_tree(tmpdir, ndirs=args.dirs, nlinks=args.links)
+    try:
+        shell_secs, shell_rows = timeit(run_shell_table, root)
+        py_secs, py_rows = timeit(run_lntable, root)
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    print("links:        {}".format(len(py_rows)))
+    print("find/readlink {:.3f}s".format(shell_secs))
+    print("lntable.py    {:.3f}s ({:.1f}x)".format(
+        py_secs, shell_secs / py_secs if py_secs else float('inf')))
+    if shell_rows != py_rows:
+        shell_only = sorted(set(shell_rows) - set(py_rows))
+        py_only = sorted(set(py_rows) - set(shell_rows))
+        for row in shell_only[:10]:
+            print("FAIL: only find/readlink: {}".format(os.fsdecode(row)))
+        for row in py_only[:10]:
+            print("FAIL: only lntable.py:    {}".format(os.fsdecode(row)))
+        print("FAIL: outputs differ ({} rows vs {})".format(
+            len(shell_rows), len(py_rows)))
+        return 1
+    return 0
+
+
+def synthetic_rows(nlinks, per_dir=20, fanout=10, depth=4,
+                   root='/home/user'):
+    """
+    Yield nlinks (link, target) rows shaped like a real home directory
+    without touching the disk: per_dir links in each leaf directory of
+    a fanout-wide, depth-deep tree, pointing at files in other leaves.
+    """
+    ndirs = max(1, nlinks // per_dir)
+
+    def leaf(i):
+        parts = ['d{}'.format((i // fanout ** level) % fanout)
+                 for level in range(depth - 1, 0, -1)]
+        return '/'.join([root] + parts + ['leaf{}'.format(i)])
+
+    for i in range(nlinks):
+        d, j = divmod(i, per_dir)
+        yield ('{}/ln{}'.format(leaf(d), j),
+               '{}/file{}'.format(leaf((d * 7 + j) % ndirs), j % 3))
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def _measure(build, queries):
+    """
+    Build a table in a forked child, so each one starts from the same
+    heap, and report its resident size and timings as a dict.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        before = _rss()
+        start = time.perf_counter()
+        table = build()
+        built = time.perf_counter()
+        for query in queries:
+            table.links_to(query)
+        done = time.perf_counter()
+        result = {'rss': _rss() - before, 'build': built - start,
+                  'query': (done - built) / len(queries)}
+        os.write(wfd, json.dumps(result).encode())
+        os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        result = json.loads(f.read() or 'null')
+    os.waitpid(pid, 0)
+    return result
+
+
+class DictTable(object):
+    """ The naive version: forward and reverse dicts of strings """
+
+    def __init__(self, rows):
+        self.targets = {}
+        self.by_target = {}
+        for link, target in rows:
+            self.targets[link] = target
+            self.by_target.setdefault(target, []).append(link)
+
+    def links_to(self, target):
+        return [(link, target) for link in self.by_target.get(target, [])]
+
+
+def bench_memory(args):
+    """ compare linkstore's memory use with a dict of strings """
+    rows = lambda: synthetic_rows(args.links, per_dir=args.per_dir)
+    queries = [target for link, target in
+               synthetic_rows(min(args.links, 1000), per_dir=args.per_dir)]
+    print("links: {:,}".format(args.links))
+    base = None
+    for name, build in (('dict', lambda: DictTable(rows())),
+                        ('linkstore', lambda: linkstore.LinkStore(rows()))):
+        result = _measure(build, queries)
+        if result is None:
+            print("{:10} failed".format(name))
+            return 1
+        base = base or result['rss']
+        print("{:10} {:9,.1f} MB  {:6.1f} bytes/link  ({:.2f}x)  "
+              "build {:.1f}s  links_to {:.1f}us".format(
+                  name, result['rss'] / 1e6, result['rss'] / args.links,
+                  base / result['rss'] if result['rss'] else float('inf'),
+                  result['build'], result['query'] * 1e6))
+    return 0
+
+
+def bench_suggest(args):
+    """ compare symlink_edit's batch suggestions with the scalar ones """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    root = make_tree(os.path.join(tmpdir, 'tree'), ndirs=args.dirs,
+                     nlinks=args.links)
+    # some awkward cases alongside make_tree's plain ones
+    os.symlink('/', os.path.join(root, 'slash'))
+    os.symlink('//' + root.lstrip('/') + '/./d0/../d0', os.path.join(
+        root, 'dotted'))
+    os.symlink('nowhere/at/all', os.path.join(root, 'broken'))
+    os.symlink('dotted', os.path.join(root, 'chained'))
+    os.symlink(tmpdir, os.path.join(root, '.userroot'))
+    links = sorted(os.path.relpath(link, root)
+                   for link, target in lntable.iter_table([root]))
+    links += [os.path.join(root, link) for link in links[::3]]
+    links += [os.path.join('..', 'tree', link) for link in links[1::5]
+              if not os.path.isabs(link)]
+
+    oldcwd = os.getcwd()
+    oldenv = {name: os.environ.get(name) for name in ('PWD', 'USERROOT')}
+    os.chdir(root)
+    os.environ['PWD'] = root
+    failures = []
+
+    def check(expected, got):
+        for a, b in zip(expected, got):
+            if a != b:
+                failures.append((a['origlink'], sorted(
+                    key for key in a if a[key] != b.get(key))))
+        if len(expected) != len(got):
+            failures.append(('(count)', [len(expected), len(got)]))
+
+    try:
+        for userroot in (tmpdir, None):
+            if userroot is None:
+                os.environ.pop('USERROOT', None)
+            else:
+                os.environ['USERROOT'] = userroot
+            expected = [symlink_edit.get_values_from_link(link, False, False)
+                        for link in links]
+            got = symlink_edit.get_values_from_links(links, False, False)
+            check(expected, got)
+        os.remove('.userroot')
+        # or both would go on resolving the cached link
+        pathcache.invalidate('.userroot')
+        remaining = [link for link in links
+                     if os.path.basename(link) != '.userroot']
+        expected = [symlink_edit.get_values_from_link(link, False, False)
+                    for link in remaining]
+        got = symlink_edit.get_values_from_links(remaining, False, False)
+        check(expected, got)
+        # make sure that really was the no-.userroot fallback
+        failures.extend((values['origlink'], ['suggestion-userroot'])
+                        for values in expected
+                        if values['suggestion-userroot'] != "")
+
+        # both warm pathcache the same way, so time the path arithmetic
+        os.environ['USERROOT'] = tmpdir
+        os.symlink(tmpdir, '.userroot')
+        pathcache.invalidate('.userroot')
+        scalar_secs, expected = timeit(
+            lambda: [symlink_edit.get_values_from_link(link, False, False)
+                     for link in links])
+        batch_secs, got = timeit(
+            symlink_edit.get_values_from_links, links, False, False)
+        check(expected, got)
+    finally:
+        os.chdir(oldcwd)
+        for name, value in oldenv.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(tmpdir)
+    print("links:  {}".format(len(links)))
+    print("scalar  {:.3f}s".format(scalar_secs))
+    print("batch   {:.3f}s ({:.1f}x)".format(
+        batch_secs, scalar_secs / batch_secs if batch_secs else float('inf')))
+    if failures:
+        for link, keys in failures[:20]:
+            print("FAIL: {}: {} differ".format(link, ', '.join(
+                str(key) for key in keys)))
+        print("FAIL: {} result(s) differ".format(len(failures)))
+        return 1
+    print("results identical")
+    return 0
+
+
+def bench_fsops(args):
+    """ time make_the_move with fsops instrumentation off and on """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    for name in ('a', 'b'):
+        open(os.path.join(tmpdir, name), 'w').close()
+    link = os.path.join(tmpdir, 'link')
+    os.symlink('a', link)
+
+    def swaps():
+        for i in range(args.swaps):
+            symlink_edit.make_the_move(link, link, 'ab'[i % 2])
+
+    try:
+        swaps()
+        off_secs, result = timeit(swaps)
+        fsops.enable()
+        on_secs, result = timeit(swaps)
+        fsops.disable()
+    finally:
+        shutil.rmtree(tmpdir)
+    print("swaps:  {}".format(args.swaps))
+    print("off     {:.3f}s  {:.1f}us/swap".format(
+        off_secs, 1e6 * off_secs / args.swaps))
+    print("on      {:.3f}s  {:.1f}us/swap".format(
+        on_secs, 1e6 * on_secs / args.swaps))
+    print(fsops.report())
+    return 0
+
+
+LNEDIT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'lnedit-urwid.py')
+# lnedit as it started before the UI was imported lazily
+EAGER_LNEDIT = ('import runpy, sys, symlink_ui_urwid; '
+                'sys.argv[:2] = [sys.argv[1]]; '
+                'runpy.run_path(sys.argv[0], run_name="__main__")')
+
+
+def bench_startup(args):
+    """ time lnedit's headless startup, with and without importing urwid """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    open(os.path.join(tmpdir, 'a'), 'w').close()
+    link = os.path.join(tmpdir, 'link')
+    os.symlink('a', link)
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(LNEDIT))
+    commands = [
+        ('python', [sys.executable, '-c', 'pass']),
+        ('lazy', [sys.executable, LNEDIT, '--values', link]),
+        ('eager', [sys.executable, '-c', EAGER_LNEDIT, LNEDIT, '--values',
+                   link]),
+    ]
+    times = {}
+    try:
+        for name, command in commands:
+            runs = []
+            for i in range(args.runs):
+                start = time.perf_counter()
+                result = subprocess.run(command, env=env, cwd=tmpdir,
+                                        stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.PIPE)
+                runs.append(time.perf_counter() - start)
+                if result.returncode:
+                    sys.stderr.write("{}: {}".format(
+                        name, result.stderr.decode(errors='replace')))
+                    break
+            else:
+                runs.sort()
+                times[name] = runs
+    finally:
+        shutil.rmtree(tmpdir)
+    print("{:<8} {:>9} {:>9}".format('', 'min ms', 'median ms'))
+    for name, command in commands:
+        if name in times:
+            runs = times[name]
+            print("{:<8} {:>9.1f} {:>9.1f}".format(
+                name, 1e3 * runs[0], 1e3 * runs[len(runs) // 2]))
+        else:
+            print("{:<8} {:>9} {:>9}".format(name, 'failed', ''))
+    if 'lazy' in times and 'eager' in times:
+        lazy = times['lazy'][len(times['lazy']) // 2]
+        eager = times['eager'][len(times['eager']) // 2]
+        print("lazy import saves {:.1f}ms per run ({:.2f}x)".format(
+            1e3 * (eager - lazy), eager / lazy))
+    return 0 if len(times) == len(commands) else 1
+
+
+def bench_dirfd(args):
+    """ retarget links in deep directories by full path and by dir fd """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    links = []
+    for d in range(args.dirs):
+        deep = os.path.join(tmpdir, *('level{:02d}-{}'.format(i, d)
+                                       for i in range(args.depth)))
+        os.makedirs(deep)
+        for name in ('a', 'b'):
+            open(os.path.join(deep, name), 'w').close()
+        for i in range(args.links):
+            links.append(os.path.join(deep, 'link{}'.format(i)))
+            os.symlink('a', links[-1])
+
+    def by_path(target):
+        for link in links:
+            symlink_edit.make_the_move(link, link, target)
+
+    def by_dirfd(target):
+        errors = dirfd.relink([(link, target) for link in links])
+        assert not any(errors), errors
+
+    results = {}
+    try:
+        for name, func in (('path', by_path), ('dirfd', by_dirfd)):
+            secs = []
+            for i in range(args.rounds):
+                pathcache.default_cache.clear()
+                secs.append(timeit(func, 'ab'[i % 2])[0])
+            # and once more to count the calls
+            pathcache.default_cache.clear()
+            fsops.enable()
+            func('ab'[args.rounds % 2])
+            fsops.disable()
+            # the stats and readlinks do little but look the path up
+            lookups = [op for op in fsops.counts
+                       if op not in ('symlink', 'replace', 'open', 'close')]
+            results[name] = (min(secs), sum(fsops.counts.values()),
+                             sum(fsops.seconds[op] for op in lookups) /
+                             sum(fsops.counts[op] for op in lookups))
+            fsops.counts.clear()
+            fsops.seconds.clear()
+            fsops.errors.clear()
+    finally:
+        shutil.rmtree(tmpdir)
+    print("{} links in {} directories {} levels deep".format(
+        len(links), args.dirs, args.depth))
+    for name, (secs, calls, stat_secs) in results.items():
+        print("{:<6} {:8.3f}s  {:6.1f}us/link  {:5.1f} calls/link  "
+              "{:5.2f}us/lookup".format(name, secs, 1e6 * secs / len(links),
+                                      calls / len(links), 1e6 * stat_secs))
+    print("dir fd speedup: {:.2f}x".format(
+        results['path'][0] / results['dirfd'][0]))
+    return 0
+
+
+def bench_shards(args):
+    """ build one index over several roots vs a shard per root at once """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    try:
+        roots = [make_tree(os.path.join(tmpdir, 'root{}'.format(i)),
+                           ndirs=args.dirs, nlinks=args.links)
+                 for i in range(args.roots)]
+        target = os.path.join(roots[0], 'd0', 'd0', 'leaf0', 'file')
+
+        def single():
+            index = lnindex.LinkIndex(os.path.join(tmpdir, 'single.db'))
+            for root in roots:
+                index.update(root, full=True)
+            return index
+
+        def sharded():
+            lnshards.main(['-d', os.path.join(tmpdir, 'shards'), 'update',
+                           '--full', '-P', str(args.roots)] + roots)
+            return lnshards.ShardSet(os.path.join(tmpdir, 'shards'))
+
+        for name, build in (('single', single), ('shards', sharded)):
+            secs, index = timeit(build)
+            qsecs, count = timeit(lambda: sum(
+                len(list(index.links_to(target)))
+                for i in range(args.queries)))
+            index.close()
+            print("{:<6} build {:8.3f}s  query {:7.1f}us  ({} links to "
+                  "{})".format(name, secs, 1e6 * qsecs / args.queries,
+                               count // args.queries, target))
+    finally:
+        shutil.rmtree(tmpdir)
+    return 0
+
+
+def bench_walk(args):
+    """ time lntable's pool walker with 1..N threads """
+    root = args.root
+    tmpdir = None
+    if root is None:
+        tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+        root = make_tree(tmpdir, ndirs=args.dirs, nlinks=args.links)
+    try:
+        base = None
+        for jobs in range(1, args.jobs + 1):
+            secs, count = timeit(
+                lambda: sum(1 for row in lntable.iter_table(
+                    [root], jobs=jobs, one_file_system=True)))
+            base = base or secs
+            print("-j {:<3} {:8.3f}s  {:5.2f}x  ({} links)".format(
+                jobs, secs, base / secs if secs else float('inf'), count))
+    finally:
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    return 0
+
+
+def bench_atomic(args):
+    """ hammer a symlink with readers while make_the_move swaps it """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    targets = []
+    for name in ('a', 'b'):
+        targets.append(os.path.join(tmpdir, name))
+        with open(targets[-1], 'w') as f:
+            f.write(name)
+    link = os.path.join(tmpdir, 'link')
+    os.symlink(targets[0], link)
+    stop = threading.Event()
+    reads = []
+    misses = []
+    wrong = []
+
+    def reader():
+        count = 0
+        missed = 0
+        bad = 0
+        while not stop.is_set():
+            try:
+                value = os.readlink(link)
+                with open(link) as f:
+                    content = f.read()
+                # a half-written or foreign link would show up here
+                if value not in targets or content not in ('a', 'b'):
+                    bad += 1
+            except FileNotFoundError:
+                missed += 1
+            count += 1
+        reads.append(count)
+        misses.append(missed)
+        wrong.append(bad)
+
+    readers = [threading.Thread(target=reader) for i in range(args.readers)]
+    for thread in readers:
+        thread.start()
+    problems = []
+    try:
+        start = time.perf_counter()
+        for i in range(args.swaps):
+            symlink_edit.make_the_move(link, link, targets[i % 2],
+                                       savebackup=args.backup)
+        secs = time.perf_counter() - start
+        stop.set()
+        for thread in readers:
+            thread.join()
+        # the last swap (and with -b, the one before it) must have stuck
+        if os.readlink(link) != targets[(args.swaps - 1) % 2]:
+            problems.append("link lost its last update")
+        if args.backup and args.swaps > 1 and (
+                os.readlink(link + '~') != targets[args.swaps % 2]):
+            problems.append("backup doesn't hold the previous target")
+        leftovers = sorted(name for name in os.listdir(tmpdir)
+                           if name.endswith('.tmp'))
+        if leftovers:
+            problems.append("temporary links left behind: {}".format(
+                ' '.join(leftovers)))
+    finally:
+        stop.set()
+        for thread in readers:
+            thread.join()
+        shutil.rmtree(tmpdir)
+    if sum(misses):
+        problems.append("readers saw ENOENT {} times".format(sum(misses)))
+    if sum(wrong):
+        problems.append("readers saw a wrong target {} times".format(
+            sum(wrong)))
+    print("swaps:  {} in {:.3f}s".format(args.swaps, secs))
+    print("reads:  {}".format(sum(reads)))
+    print("ENOENT: {}".format(sum(misses)))
+    for problem in problems:
+        print("FAIL: {}".format(problem))
+    return 1 if problems else 0
+
+
+def gen_tree(root, seed=0, fanout=4, depth=3, files=4, links=8, broken=0.05,
+             chains=0.2, max_chain=4, relative=0.5):
+    """
+    Build a reproducible synthetic tree under root and return a summary
+    dict.  Every directory down to depth levels has fanout subdirectories,
+    files regular files and links symlinks.  Each link is broken with
+    probability broken, points at an earlier link (making a chain of at
+    most max_chain hops) with probability chains, and otherwise points
+    at a random file or directory; it's relative with probability
+    relative.  The same arguments always give the same tree.
+    """
+    rng = random.Random(seed)
+    root = os.path.abspath(root)
+    dirs = [root]
+    level = [root]
+    for depth_left in range(depth):
+        level = [os.path.join(parent, 'd{}'.format(i))
+                 for parent in level for i in range(fanout)]
+        dirs.extend(level)
+    targets = []
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+        for i in range(files):
+            target = os.path.join(path, 'f{}'.format(i))
+            with open(target, 'w') as f:
+                f.write(target)
+            targets.append(target)
+    targets.extend(dirs)
+
+    summary = {'dirs': len(dirs), 'files': len(dirs) * files, 'links': 0,
+               'broken': 0, 'chained': 0, 'relative': 0}
+    hops = {}
+    # the links made so far, in order, to sample from without copying
+    # hops every time
+    made = []
+    for path in dirs:
+        for i in range(links):
+            link = os.path.join(path, 'l{}'.format(i))
+            roll = rng.random()
+            short = [l for l in rng.sample(made, min(len(made), 8))
+                     if hops[l] < max_chain] if made else []
+            if roll < broken:
+                target = os.path.join(rng.choice(dirs),
+                                      'missing{}'.format(i))
+                summary['broken'] += 1
+            elif roll < broken + chains and short:
+                target = short[0]
+                hops[link] = hops[target] + 1
+                summary['chained'] += 1
+            else:
+                target = rng.choice(targets)
+            hops.setdefault(link, 1)
+            if rng.random() < relative:
+                target = os.path.relpath(target, path)
+                summary['relative'] += 1
+            os.symlink(target, link)
+            made.append(link)
+            summary['links'] += 1
+    summary['longest_chain'] = max(hops.values()) if hops else 0
+    return summary
+
+
+# os functions counted by the suite: everything the tools use that
+# costs a syscall (os.path and shutil go through these too)
+COUNTED_CALLS = ('stat', 'lstat', 'fstat', 'readlink', 'symlink', 'link',
+                 'rename', 'replace', 'remove', 'unlink', 'rmdir', 'mkdir',
+                 'scandir', 'listdir', 'open', 'chmod', 'utime', 'access',
+                 'copy_file_range', 'fsync')
+
+
+def _count_os_calls(counts):
+    """ Wrap the COUNTED_CALLS functions in os so each call is counted """
+    def wrap(name, func):
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return counted
+    for name in COUNTED_CALLS:
+        if hasattr(os, name):
+            setattr(os, name, wrap(name, getattr(os, name)))
+            # fsops holds on to the plain os functions
+            if name in fsops.OPERATIONS:
+                fsops.OPERATIONS[name] = getattr(os, name)
+                setattr(fsops, name, getattr(os, name))
+
+
+def _proc_io():
+    try:
+        with open('/proc/self/io') as f:
+            return dict((key, int(value)) for key, value in
+                        (line.split(': ') for line in f))
+    except OSError:
+        return {}
+
+
+def _run_case(func):
+    """
+    Run func (which returns the number of operations it did) in a
+    forked child with os calls counted, and return its measurements.
+    Forking gives every case a fresh peak RSS and keeps the counting
+    wrappers out of this process.  peak_rss_kb is how far the child's
+    peak RSS rose above what it held (shared with this process) at the
+    fork.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            # start cold, whatever the parent has resolved already
+            pathcache.default_cache.clear()
+            counts = {}
+            _count_os_calls(counts)
+            # a forked child starts with its parent's resident pages
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            io = _proc_io()
+            start = time.perf_counter()
+            ops = func()
+            secs = time.perf_counter() - start
+            calls = dict(counts)
+            after = _proc_io()
+            result = {
+                'seconds': secs, 'ops': ops,
+                'us_per_op': 1e6 * secs / ops if ops else None,
+                'os_calls': calls, 'os_calls_total': sum(calls.values()),
+                'read_syscalls': after.get('syscr', 0) - io.get('syscr', 0),
+                'write_syscalls': after.get('syscw', 0) - io.get('syscw', 0),
+                'peak_rss_kb': resource.getrusage(
+                    resource.RUSAGE_SELF).ru_maxrss - rss,
+            }
+        except Exception as err:
+            result = {'error': repr(err)}
+        os.write(wfd, json.dumps(result).encode())
+        os._exit(0)
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        result = json.loads(f.read() or '{"error": "child died"}')
+    os.waitpid(pid, 0)
+    return result
+
+
+def suite_cases(tmpdir, tree, ops):
+    """
+    Return [(name, func)] for the suite.  The read-only cases work on
+    tree; the others on scratch directories set up here, ops at a time.
+    """
+    rng = random.Random(0)
+    scratch = os.path.join(tmpdir, 'scratch')
+    # lookup gets an index of its own, built here and not timed
+    lookupdb = os.path.join(tmpdir, 'lookup.db')
+    index = lnindex.LinkIndex(lookupdb)
+    index.update(tree)
+    index.close()
+
+    def table():
+        return sum(1 for row in lntable.iter_table([tree]))
+
+    def index_build():
+        index = lnindex.LinkIndex(os.path.join(tmpdir, 'lnindex.db'))
+        stats = index.update(tree)
+        index.close()
+        return stats.links
+
+    def lookup():
+        index = lnindex.LinkIndex(lookupdb)
+        rows = list(index.iter_table())
+        queries = [target for link, target in rng.sample(
+            rows, min(ops, len(rows)))]
+        for target in queries:
+            list(index.links_to(target))
+        index.close()
+        return len(queries)
+
+    swapdir = os.path.join(scratch, 'swapln')
+    for i in range(ops):
+        os.makedirs(os.path.join(swapdir, 'old{}'.format(i)))
+        os.symlink('old{}'.format(i), os.path.join(swapdir, 'new{}'.format(i)))
+
+    def swap():
+        for i in range(ops):
+            swapln.swapln(os.path.join(swapdir, 'old{}'.format(i)),
+                          os.path.join(swapdir, 'new{}'.format(i)),
+                          forsure=True)
+        return ops
+
+    mvdir = os.path.join(scratch, 'symmv')
+    os.makedirs(os.path.join(mvdir, 'dst'))
+    for i in range(ops):
+        with open(os.path.join(mvdir, 'src{}'.format(i)), 'w') as f:
+            f.write('x' * 4096)
+
+    def move():
+        for i in range(ops):
+            symmv.symmv(os.path.join(mvdir, 'src{}'.format(i)),
+                        os.path.join(mvdir, 'dst', 'src{}'.format(i)),
+                        quiet=True)
+        return ops
+
+    movedir = os.path.join(scratch, 'make_the_move')
+    os.makedirs(movedir)
+    for name in ('a', 'b'):
+        open(os.path.join(movedir, name), 'w').close()
+    for i in range(ops):
+        os.symlink('a', os.path.join(movedir, 'l{}'.format(i)))
+
+    def retarget():
+        for i in range(ops):
+            link = os.path.join(movedir, 'l{}'.format(i))
+            symlink_edit.make_the_move(link, link, 'b')
+        return ops
+
+    return [('table', table), ('index_build', index_build),
+            ('lookup', lookup), ('swapln', swap), ('symmv', move),
+            ('make_the_move', retarget)]
+
+
+def bench_suite(args):
+    """ time every tool on a generated tree and write the results as JSON """
+    tmpdir = tempfile.mkdtemp(prefix='lnbench-')
+    params = {'seed': args.seed, 'fanout': args.fanout, 'depth': args.depth,
+              'files': args.files, 'links': args.links,
+              'broken': args.broken, 'chains': args.chains,
+              'max_chain': args.max_chain, 'relative': args.relative}
+    try:
+        tree = os.path.join(tmpdir, 'tree')
+        summary = gen_tree(tree, **params)
+        results = {'params': dict(params, ops=args.ops), 'tree': summary,
+                   'python': sys.version.split()[0], 'cases': {}}
+        for name, func in suite_cases(tmpdir, tree, args.ops):
+            if args.only and name not in args.only:
+                continue
+            result = results['cases'][name] = _run_case(func)
+            if 'error' in result:
+                sys.stderr.write("{:14} ERROR {}\n".format(
+                    name, result['error']))
+            else:
+                sys.stderr.write(
+                    "{:14} {:8.3f}s  {:>7} ops  {:>8} os calls  "
+                    "{:>7} KB peak\n".format(
+                        name, result['seconds'], result['ops'],
+                        result['os_calls_total'], result['peak_rss_kb']))
+    finally:
+        shutil.rmtree(tmpdir)
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 1 if any('error' in r for r in results['cases'].values()) else 0
+
+
+def bench_compare(args):
+    """ compare two suite JSON files, case by case """
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get('params') != new.get('params'):
+        print("WARNING: the runs used different parameters")
+    worse = 0
+    for name in sorted(set(old['cases']) & set(new['cases'])):
+        a, b = old['cases'][name], new['cases'][name]
+        if 'error' in a or 'error' in b:
+            print("{:14} (error in one run)".format(name))
+            continue
+        ratio = b['seconds'] / a['seconds'] if a['seconds'] else float('inf')
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  SLOWER'
+            worse += 1
+        print("{:14} {:8.3f}s -> {:8.3f}s  ({:.2f}x)  os calls {} -> {}{}"
+              .format(name, a['seconds'], b['seconds'], ratio,
+                      a['os_calls_total'], b['os_calls_total'], flag))
+    return 1 if worse else 0
+
+
+def bench_generate(args):
+    """ write a synthetic tree (as the suite makes them) to a directory """
+    summary = gen_tree(args.root, seed=args.seed, fanout=args.fanout,
+                       depth=args.depth, files=args.files, links=args.links,
+                       broken=args.broken, chains=args.chains,
+                       max_chain=args.max_chain, relative=args.relative)
+    json.dump(summary, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    return 0
+
+
+def _tree_arguments(parser):
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed; the same seed gives the same tree')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='subdirectories per directory')
+    parser.add_argument('--depth', type=int, default=4,
+                        help='levels of subdirectories')
+    parser.add_argument('--files', type=int, default=4,
+                        help='regular files per directory')
+    parser.add_argument('--links', type=int, default=8,
+                        help='symlinks per directory')
+    parser.add_argument('--broken', type=float, default=0.05,
+                        help='fraction of links that are broken')
+    parser.add_argument('--chains', type=float, default=0.2,
+                        help='fraction of links that point at another link')
+    parser.add_argument('--max-chain', type=int, default=4,
+                        help='longest chain of links to build')
+    parser.add_argument('--relative', type=float, default=0.5,
+                        help='fraction of links that are relative')
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    table = subparsers.add_parser('table', help=bench_table.__doc__)
+    table.add_argument('--root', help='existing tree to scan '
+                       '(default: generate a synthetic one)')
+    table.add_argument('--dirs', type=int, default=100,
+                       help='directories in the synthetic tree')
+    table.add_argument('--links', type=int, default=20,
+                       help='symlinks per directory in the synthetic tree')
+    table.set_defaults(func=bench_table)
+
+    walk = subparsers.add_parser('walk', help=bench_walk.__doc__)
+    walk.add_argument('--root', help='existing tree to scan '
+                      '(default: generate a synthetic one)')
+    walk.add_argument('--dirs', type=int, default=2000,
+                      help='directories in the synthetic tree')
+    walk.add_argument('--links', type=int, default=20,
+                      help='symlinks per directory in the synthetic tree')
+    walk.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                      help='largest pool size to try')
+    walk.set_defaults(func=bench_walk)
+
+    memory = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--links', type=int, default=5000000,
+                        help='links in the synthetic table')
+    memory.add_argument('--per-dir', type=int, default=20,
+                        help='links per directory in the synthetic table')
+    memory.set_defaults(func=bench_memory)
+
+    suggest = subparsers.add_parser('suggest', help=bench_suggest.__doc__)
+    suggest.add_argument('--dirs', type=int, default=1000,
+                         help='directories in the synthetic tree')
+    suggest.add_argument('--links', type=int, default=20,
+                         help='symlinks per directory in the synthetic tree')
+    suggest.set_defaults(func=bench_suggest)
+
+    fsopsbench = subparsers.add_parser('fsops', help=bench_fsops.__doc__)
+    fsopsbench.add_argument('--swaps', type=int, default=20000,
+                            help='number of times to retarget the link')
+    fsopsbench.set_defaults(func=bench_fsops)
+
+    dirfdbench = subparsers.add_parser('dirfd', help=bench_dirfd.__doc__)
+    dirfdbench.add_argument('--depth', type=int, default=32,
+                            help='directory levels above the links')
+    dirfdbench.add_argument('--dirs', type=int, default=10,
+                            help='deep directories to put links in')
+    dirfdbench.add_argument('--links', type=int, default=1000,
+                            help='symlinks per directory')
+    dirfdbench.add_argument('--rounds', type=int, default=3,
+                            help='times to retarget every link')
+    dirfdbench.set_defaults(func=bench_dirfd)
+
+    shards = subparsers.add_parser('shards', help=bench_shards.__doc__)
+    shards.add_argument('--roots', type=int, default=4,
+                        help='separate trees (and so shards) to index')
+    shards.add_argument('--dirs', type=int, default=2000,
+                        help='directories in each tree')
+    shards.add_argument('--links', type=int, default=20,
+                        help='symlinks per directory')
+    shards.add_argument('--queries', type=int, default=200,
+                        help='links_to lookups to time')
+    shards.set_defaults(func=bench_shards)
+
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('--runs', type=int, default=20,
+                         help='times to start each command')
+    startup.set_defaults(func=bench_startup)
+
+    atomic = subparsers.add_parser('atomic', help=bench_atomic.__doc__)
+    atomic.add_argument('--swaps', type=int, default=20000,
+                        help='number of times to retarget the link')
+    atomic.add_argument('--readers', type=int, default=4,
+                        help='number of reader threads')
+    atomic.add_argument('-b', '--backup', action='store_true',
+                        help='save a tilde backup on every swap')
+    atomic.set_defaults(func=bench_atomic)
+
+    suite = subparsers.add_parser('suite', help=bench_suite.__doc__)
+    _tree_arguments(suite)
+    suite.add_argument('--ops', type=int, default=1000,
+                       help='lookups, swaps, moves and retargets to time')
+    suite.add_argument('--only', action='append',
+                       help='run just this case (repeatable)')
+    suite.add_argument('-o', '--output', default='-',
+                       help='JSON results file (default: stdout)')
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser('compare', help=bench_compare.__doc__)
+    compare.add_argument('old', help='earlier suite results')
+    compare.add_argument('new', help='later suite results')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='flag cases this much slower (default: 0.1)')
+    compare.set_defaults(func=bench_compare)
+
+    generate = subparsers.add_parser('generate', help=bench_generate.__doc__)
+    _tree_arguments(generate)
+    generate.add_argument('root', help='directory to build the tree in')
+    generate.set_defaults(func=bench_generate)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Find dangling symlinks under one or more directories
+
+This replaces "find . -xtype l | xargs ls -l".  Each directory is read
+once, and whether a link's target directory exists is memoized, so a
+crowd of sibling links into the same missing directory costs one stat.
+Results are printed as they're found, either "link -> value" (like
+ls -l) or, with --json, one JSON object per line.
+"""
+
+import argparse
+import errno
+import json
+import os
+import sys
+
+import lntable
+
+
+def scan_broken(path, dir_exists):
+    """
+    pool_walk() scanner: return ([(link, value, reason), ...], subdirs)
+    for the dangling symlinks directly inside path.  dir_exists is a
+    dict shared between calls, memoizing os.path.isdir() by path.
+    """
+    broken = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                    continue
+                if not entry.is_symlink():
+                    continue
+                value = os.readlink(entry.path)
+            except OSError as err:
+                lntable._report(err)
+                continue
+            # not normalized: the kernel resolves ".." after symlinks
+            parent = os.path.dirname(os.path.join(path, value))
+            isdir = dir_exists.get(parent)
+            if isdir is None:
+                isdir = dir_exists[parent] = os.path.isdir(parent)
+            if not isdir:
+                broken.append((entry.path, value, 'missing-dir'))
+                continue
+            try:
+                os.stat(entry.path)
+            except FileNotFoundError:
+                broken.append((entry.path, value, 'missing'))
+            except OSError as err:
+                if err.errno == errno.ELOOP:
+                    broken.append((entry.path, value, 'loop'))
+                else:
+                    broken.append((entry.path, value, err.strerror))
+    return broken, subdirs
+
+
+def iter_broken(tops, jobs=1, one_file_system=False):
+    """ Yield (link, value, reason) for every dangling symlink under tops """
+    dir_exists = {}
+
+    def scan(path, st):
+        return scan_broken(path, dir_exists)
+
+    for top in tops:
+        for path, st, broken in lntable.pool_walk(top, scan, jobs,
+                                                  one_file_system):
+            if broken:
+                yield from broken
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per broken link')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    parser.add_argument('roots', nargs='*', default=['.'],
+                        help='directories to scan (default: .)')
+    args = parser.parse_args(argv)
+
+    try:
+        for link, value, reason in iter_broken(args.roots, args.jobs,
+                                               args.one_file_system):
+            if args.json:
+                print(json.dumps({'link': link, 'target': value,
+                                  'reason': reason}), flush=True)
+            else:
+                print("{} -> {}".format(link, value), flush=True)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Show the full hop chain of every symlink under a tree
+
+readlink -f and chase resolve a link all the way but throw away the
+links they passed through on the way.  lnchain.py records every hop:
+the link itself, then each symlink met while resolving its value
+(including symlinks in the middle of the value's path), up to the final
+target.  Chains are memoized per symlink, so links that share a chain
+suffix only resolve that suffix once, and a symlink met again while
+its own chain is still being resolved is reported as a loop on the
+spot.
+
+Prints one line per link with at least --min-hops hops (default 2,
+i.e. a link to a link): "link -> hop -> ... => final".  A histogram of
+chain lengths for the whole tree goes to stderr at the end.
+"""
+
+import argparse
+import collections
+import errno
+import json
+import os
+import sys
+
+import lntable
+import pathcache
+
+OK = 'ok'
+BROKEN = 'broken'
+LOOP = 'loop'
+
+
+class Chain(collections.namedtuple('Chain', 'hops final status')):
+    """
+    hops: the symlinks passed through, starting with the link itself
+    final: where they end up (None for a loop)
+    status: OK, BROKEN (final doesn't exist) or LOOP
+    """
+    __slots__ = ()
+
+
+class ChainResolver(object):
+    """ Resolves symlink hop chains, memoizing one Chain per symlink """
+
+    def __init__(self):
+        self.chains = {}
+        self._resolving = set()
+
+    def _chain_of(self, link):
+        """ The Chain of symlink link, whose parent is already resolved """
+        try:
+            return self.chains[link]
+        except KeyError:
+            pass
+        if link in self._resolving:
+            return Chain((link,), None, LOOP)
+        self._resolving.add(link)
+        try:
+            value = pathcache.readlink(link)
+            rest = self.resolve(os.path.dirname(link), value)
+            chain = Chain((link,) + rest.hops, rest.final, rest.status)
+        finally:
+            self._resolving.discard(link)
+        # for a loop, hops stop where it was noticed, which depends on
+        # where we came in; any entry point is still a loop
+        self.chains[link] = chain
+        return chain
+
+    def resolve(self, path, rest=''):
+        """
+        Resolve rest relative to the resolved directory path (or all of
+        path, if rest is omitted) like os.path.realpath, returning the
+        Chain of symlinks passed through.
+        """
+        if not rest:
+            path, rest = '/', os.path.abspath(path)
+        if os.path.isabs(rest):
+            path = '/'
+        hops = ()
+        status = OK
+        for name in rest.split('/'):
+            if not name or name == '.':
+                continue
+            if name == '..':
+                path = os.path.dirname(path)
+                continue
+            newpath = os.path.join(path, name)
+            if status == BROKEN:
+                path = newpath
+                continue
+            try:
+                pathcache.readlink(newpath)
+            except OSError as err:
+                if err.errno != errno.EINVAL:
+                    status = BROKEN
+                path = newpath
+                continue
+            chain = self._chain_of(newpath)
+            hops += chain.hops
+            if chain.status == LOOP:
+                return Chain(hops, None, LOOP)
+            if chain.status == BROKEN:
+                status = BROKEN
+            path = chain.final
+        return Chain(hops, path, status)
+
+    def chain(self, link):
+        """ Return the Chain of link, which should be a symlink """
+        parent = self.resolve(os.path.dirname(os.path.abspath(link)))
+        if parent.status == LOOP:
+            return parent
+        return self._chain_of(os.path.join(parent.final,
+                                           os.path.basename(link)))
+
+
+def scan_symlinks(path, st=None):
+    """ pool_walk() scanner: return (symlinks, subdirs) directly in path """
+    links = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_symlink():
+                    links.append(entry.path)
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError as err:
+                lntable._report(err)
+    return links, subdirs
+
+
+def iter_chains(tops, jobs=1, one_file_system=False, resolver=None):
+    """
+    Yield (link, Chain) for every symlink under tops.  Directories are
+    read by the pool; chains are resolved here, in one thread, so they
+    can share one resolver.
+    """
+    resolver = resolver or ChainResolver()
+    for top in tops:
+        for path, st, links in lntable.pool_walk(
+                pathcache.realpath(top), scan_symlinks, jobs,
+                one_file_system):
+            for link in links or ():
+                yield link, resolver.chain(link)
+
+
+def histogram(counts):
+    """ Lines of a text histogram for {hops: number of links} """
+    if not counts:
+        return []
+    width = max(counts.values())
+    lines = []
+    for hops in sorted(counts, key=lambda h: (h == LOOP, h)):
+        bar = '#' * max(1, 50 * counts[hops] // width)
+        lines.append("{:>5} {:>9}  {}".format(hops, counts[hops], bar))
+    return lines
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--min-hops', type=int, default=2,
+                        help='only print links with at least this many hops '
+                        '(default: 2; loops are always printed)')
+    parser.add_argument('--json', action='store_true',
+                        help='print one JSON object per link')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    parser.add_argument('roots', nargs='*', default=['.'],
+                        help='directories to scan (default: .)')
+    args = parser.parse_args(argv)
+
+    counts = collections.Counter()
+    try:
+        for link, chain in iter_chains(args.roots, args.jobs,
+                                       args.one_file_system):
+            counts[LOOP if chain.status == LOOP else len(chain.hops)] += 1
+            if len(chain.hops) < args.min_hops and chain.status != LOOP:
+                continue
+            if args.json:
+                print(json.dumps({'link': link, 'hops': list(chain.hops),
+                                  'final': chain.final,
+                                  'status': chain.status}), flush=True)
+            else:
+                print("{} => {}".format(" -> ".join(chain.hops),
+                                        chain.final or "(loop)"), flush=True)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    sys.stderr.write(" hops     links\n")
+    for line in histogram(counts):
+        sys.stderr.write(line + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Re-point every multi-hop symlink under a tree straight at its final target
+
+This is readlink-f-fixlink (rlf) for a whole tree: every link whose
+chain passes through another symlink (see lnchain.py) is rewritten to
+point at where the chain ends, so resolving it costs one hop.
+
+    lncollapse.py -n ~/src     # show what would change
+    lncollapse.py -r ~/src     # do it, keeping relative links relative
+
+Links are rewritten atomically, a directory at a time, by a pool of -j
+threads (see dirfd.py).  Broken chains are left alone unless -f is
+given; loops are always left alone.  The report gives each link's old
+and new value and the hops saved, with a total on stderr.
+"""
+
+import argparse
+import os
+import sys
+
+import dirfd
+import lnchain
+
+
+def collapsed_value(link, value, final, relative=False):
+    """
+    The new value for link (whose value is now value): final, made
+    relative to the link's directory if relative is set and value is
+    relative.
+    """
+    if relative and not os.path.isabs(value):
+        return os.path.relpath(final, os.path.dirname(link))
+    return final
+
+
+def iter_collapses(roots, relative=False, broken=False, jobs=1,
+                   one_file_system=False):
+    """
+    Yield (link, oldvalue, newvalue, hops saved) for every symlink under
+    roots whose chain has more than one hop.
+    """
+    for link, chain in lnchain.iter_chains(roots, jobs, one_file_system):
+        if len(chain.hops) < 2 or chain.status == lnchain.LOOP:
+            continue
+        if chain.status == lnchain.BROKEN and not broken:
+            continue
+        value = os.readlink(link)
+        yield (link, value,
+               collapsed_value(link, value, chain.final, relative),
+               len(chain.hops) - 1)
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the rewrites without doing them')
+    parser.add_argument('-r', '--relative', action='store_true',
+                        help='keep relative links relative (default: '
+                        'point every collapsed link at an absolute path)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='collapse broken chains too')
+    parser.add_argument('-b', '--backup', action='store_true',
+                        help='save a tilde backup of each rewritten symlink')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan and rewrite with this many threads')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    parser.add_argument('roots', nargs='+', help='trees to scan for symlinks')
+    args = parser.parse_args(argv)
+
+    # resolve every chain before touching anything, so no chain is
+    # measured halfway through being collapsed
+    collapses = list(iter_collapses(args.roots, args.relative, args.force,
+                                    args.jobs, args.one_file_system))
+
+    if args.dry_run:
+        errors = [None] * len(collapses)
+    else:
+        errors = dirfd.relink([(link, newvalue) for link, value, newvalue,
+                               hops in collapses],
+                              allowbroken=args.force,
+                              savebackup=args.backup, jobs=args.jobs)
+
+    rewritten = 0
+    saved = 0
+    failed = 0
+    out = sys.stdout.buffer
+    for collapse, err in zip(collapses, errors):
+        link, value, newvalue, hops = collapse
+        if err is not None:
+            failed += 1
+            sys.stderr.write("{}: {}: {}\n".format(
+                link, err.strerror or 'not found', newvalue))
+            continue
+        rewritten += 1
+        saved += hops
+        out.write(b'\t'.join(os.fsencode(p)
+                              for p in (link, value, newvalue, str(hops)))
+                  + b'\n')
+    out.flush()
+    sys.stderr.write("{} {} link(s), saving {} hop(s); {} failed\n".format(
+        'would collapse' if args.dry_run else 'collapsed', rewritten, saved,
+        failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
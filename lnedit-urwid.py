@@ -27,95 +27,125 @@ A TUI for editing symlinks
 # OTHER DEALINGS IN THE SOFTWARE.
 
 import argparse
-import os
-import symlink_ui_urwid
+import fsops
 import sys
+from symlink_edit import (get_values_from_link, make_the_move,
+                          read_link_values)
 
 
-def get_userroot():
-    userroot = os.path.realpath(os.readlink(".userroot"))
-    userroot = os.getenv('USERROOT')
-    return userroot
-
-
-def get_values_from_link(linkfile, allowbroken, savebackup):
-    """
-    Read a symlink at the given linkfile, and return a dict for passing
-    into the UI.
-    """
-
-    retval = {}
-    # first add the core data:
-
-    retval['origlink'] = linkfile
-    symlinkvalue = os.readlink(linkfile)
-    retval['targetref'] = symlinkvalue
-
-    # suggestion #1 - absolute path
-    abspath = os.path.realpath(linkfile)
-    retval['suggestion-abspath'] = abspath
-
-    # suggestion #2 - relative path to linkfile location
-    realpwd = os.path.realpath(os.getenv('PWD'))
-    if os.path.isabs(symlinkvalue):
-        newhome = os.path.normpath(os.path.join(realpwd, symlinkvalue))
-        abspath_dir = os.path.dirname(abspath)
-        symtarg_relpath = os.path.relpath(newhome, abspath_dir)
+def get_vals_json(oldvals, newvals):
+    import json
+    if newvals == 'cancel':
+        retval = json.dumps(oldvals, indent=4)
     else:
-        newhome = os.path.normpath(os.path.join(realpwd, symlinkvalue))
-        linkvalpwd = os.path.join(realpwd, os.path.dirname(linkfile))
-        symtarg_relpath = os.path.relpath(abspath, linkvalpwd)
-    retval['suggestion-relpath'] = symtarg_relpath
-
-    # suggestion #3 - .userroot alternative
-    try:
-        rel_to_userroot = os.path.relpath(abspath, get_userroot())
-        symtarg_userroot = os.path.join('.userroot', rel_to_userroot)
-    except FileNotFoundError:
-        symtarg_userroot = ""
-    retval['suggestion-userroot'] = symtarg_userroot
-
-    # add parameters that were passed in
-    retval['allowbroken'] = allowbroken
-    retval['savebackup'] = savebackup
-
+        retval = json.dumps(newvals, indent=4)
     return retval
 
 
-def make_the_move(origlink, newlinkname, newtargetref, allowbroken=False, savebackup=False):
-    # FIXME: put the imports at the top of the file
-    from pathlib import Path
-    import shutil
-    backupname = newlinkname + "~"
-
-    if Path(newtargetref).exists() or allowbroken:
-        # TODO: make this atomic by creating and moving the new symlink over
-        # the old one, rather than deleting then moving.
-        if savebackup:
-            if Path(backupname).exists():
-                os.remove(backupname)
-        if Path(newlinkname).is_symlink():
-            if savebackup:
-                os.rename(newlinkname, backupname)
-                print("Backup {} saved.".format(backupname))
-            else:
-                os.remove(newlinkname)
-        os.symlink(newtargetref, newlinkname)
+def read_manifest(infile):
+    """
+    Return a list of dicts with origlink/targetref/allowbroken/savebackup
+    keys from a batch manifest.  The manifest is either JSON (a list of
+    objects, or one object per line) or TSV with
+    "origlink<TAB>targetref[<TAB>flags]" rows, where flags is made of
+    the letters of the -f/-b options.  The whole manifest is read and
+    checked up front, so a bad entry raises ValueError before any link
+    is touched.
+    """
+    import json
+    from itertools import chain
+    first = infile.readline()
+    lines = chain([first], infile)
+    if first.lstrip().startswith('['):
+        entries = json.loads(first + infile.read())
+        if not isinstance(entries, list):
+            raise ValueError("manifest: expected a list of objects")
+    elif first.lstrip().startswith('{'):
+        entries = [json.loads(line) for line in lines if line.strip()]
     else:
-        raise FileNotFoundError(newtargetref)
-    retval = "{} -> {}".format(newlinkname, newtargetref)
-    if not Path(newtargetref).exists():
-        retval += "\nNOTE: {} doesn't appear to exist.".format(newtargetref)
-    return retval
+        entries = None
+    results = []
+    if entries is not None:
+        for i, entry in enumerate(entries):
+            if not (isinstance(entry, dict) and
+                    isinstance(entry.get('origlink'), str) and
+                    isinstance(entry.get('targetref'), str)):
+                raise ValueError("manifest entry {}: expected an object "
+                                 "with origlink and targetref "
+                                 "strings".format(i))
+            flags = entry.get('flags', '')
+            if not isinstance(flags, str):
+                raise ValueError("manifest entry {}: flags must be a "
+                                 "string".format(i))
+            for key in ('allowbroken', 'savebackup'):
+                if not isinstance(entry.get(key, False), bool):
+                    raise ValueError("manifest entry {}: {} must be true "
+                                     "or false".format(i, key))
+            results.append({
+                'origlink': entry['origlink'],
+                'targetref': entry['targetref'],
+                'allowbroken': entry.get('allowbroken', 'f' in flags),
+                'savebackup': entry.get('savebackup', 'b' in flags)})
+        return results
+    for lineno, line in enumerate(lines, 1):
+        fields = line.rstrip('\n').split('\t')
+        if not fields[0] or fields[0].startswith('#'):
+            continue
+        if len(fields) < 2:
+            raise ValueError("manifest line {}: expected "
+                             "origlink<TAB>targetref".format(lineno))
+        flags = fields[2] if len(fields) > 2 else ''
+        results.append({'origlink': fields[0],
+                        'targetref': fields[1],
+                        'allowbroken': 'f' in flags,
+                        'savebackup': 'b' in flags})
+    return results
 
 
-def get_vals_json(oldvals, newvals):
+def run_batch(entries, allowbroken=False, savebackup=False, outfile=None):
+    """
+    Apply make_the_move to every manifest entry, writing one JSON result
+    per line to outfile.  Returns the number of failed entries.  Each
+    link's directory is opened once and kept open for the entries after
+    it (see dirfd.py).
+    """
     import json
-    if newvals == 'cancel':
-        retval = json.dumps(oldvals, indent=4)
-    else:
-        retval = json.dumps(newvals, indent=4)
-    return retval
+    import dirfd
+    outfile = outfile or sys.stdout
+    failures = 0
+    dirs = dirfd.DirCache()
+    for entry in entries:
+        result = {'origlink': entry['origlink'],
+                  'targetref': entry['targetref']}
+        try:
+            directory, name = dirs.split(entry['origlink'])
+            directory.make_the_move(
+                name, entry['targetref'],
+                allowbroken=entry['allowbroken'] or allowbroken,
+                savebackup=entry['savebackup'] or savebackup)
+            result['status'] = 'ok'
+        except FileNotFoundError as err:
+            result['status'] = 'error'
+            # make_the_move() raises FileNotFoundError(target) itself,
+            # with no errno; a real ENOENT (say, no such directory for
+            # the link) names its own path
+            if err.errno is None:
+                result['error'] = 'target not found'
+            else:
+                result['error'] = str(err)
+        except FileExistsError:
+            # make_the_move() won't clobber a real file or directory
+            result['status'] = 'error'
+            result['error'] = 'not a symlink'
+        except OSError as err:
+            result['status'] = 'error'
+            result['error'] = str(err)
+        if result['status'] != 'ok':
+            failures += 1
+        outfile.write(json.dumps(result) + '\n')
+    dirs.close()
+    outfile.flush()
+    return failures
 
 
 def main(argv=None):
@@ -130,12 +160,57 @@ def main(argv=None):
                         help='Write the symlink even if it\'s broken', action="store_true")
     parser.add_argument('-j', '--just-print',
                         help='just print the JSON for debugging', action="store_true")
-    parser.add_argument('symlink', help='symlink for editing')
-    args = parser.parse_args()
+    parser.add_argument('-t', '--target',
+                        help='point the symlink at TARGET without the UI '
+                        '(with -j, print the JSON instead)')
+    parser.add_argument('--values', action='store_true',
+                        help="print the symlink's value and suggested "
+                        'rewrites as JSON without the UI')
+    parser.add_argument('--batch', metavar='MANIFEST',
+                        help='rewrite every link in a JSON or TSV manifest '
+                        '("-" for stdin) without the UI, printing one JSON '
+                        'result per line')
+    parser.add_argument('-i', '--index',
+                        help='symlink index to tab-complete targets from '
+                        "(default: lnindex.py's)")
+    parser.add_argument('--profile', action='store_true',
+                        help='print counts and times of filesystem calls '
+                        'to stderr at exit')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a JSON line per filesystem call to FILE')
+    parser.add_argument('symlink', help='symlink for editing', nargs='?')
+    args = parser.parse_args(argv)
+    fsops.start(args.profile, args.trace)
 
-    # 1. get oldvals from symlink given on cli
+    # 0.5. batch mode skips the UI entirely
+    if args.batch:
+        try:
+            if args.batch == '-':
+                failures = run_batch(read_manifest(sys.stdin),
+                                     allowbroken=args.force,
+                                     savebackup=args.backup)
+            else:
+                with open(args.batch) as manifest:
+                    failures = run_batch(read_manifest(manifest),
+                                         allowbroken=args.force,
+                                         savebackup=args.backup)
+        except (ValueError, KeyError) as err:
+            print("Bad manifest: {}".format(err), file=sys.stderr)
+            sys.exit(2)
+        sys.exit(1 if failures else 0)
+    if not args.symlink:
+        parser.error('a symlink to edit (or --batch) is required')
+
+    # 1. get oldvals from symlink given on cli; the UI works out the
+    # suggestions in the background, so it only needs the link's value
+    headless = args.values or args.target is not None
     try:
-        oldvals = get_values_from_link(args.symlink,
+        if headless:
+            oldvals = get_values_from_link(args.symlink,
+                                           allowbroken=args.force,
+                                           savebackup=args.backup)
+        else:
+            oldvals = read_link_values(args.symlink,
                                        allowbroken=args.force,
                                        savebackup=args.backup)
     except OSError:
@@ -143,8 +218,24 @@ def main(argv=None):
         parser.print_usage()
         sys.exit(1)
 
-    # 2. get newvals from user interface
-    newvals = symlink_ui_urwid.start_main_loop(oldvals)
+    # 2. get newvals from the command line or the user interface; the
+    # UI (and urwid, which dominates startup) is only imported here
+    if args.values:
+        print(get_vals_json(oldvals, 'cancel'))
+        sys.exit()
+    elif args.target is not None:
+        newvals = dict(oldvals, targetref=args.target, deleteorig=False)
+    else:
+        import lnindex
+        import symlink_ui_urwid
+        from symlink_edit import TargetCompleter
+
+        def suggest():
+            return get_values_from_link(args.symlink, allowbroken=args.force,
+                                        savebackup=args.backup)
+        completer = TargetCompleter(args.index or lnindex.default_index_path())
+        newvals = symlink_ui_urwid.start_main_loop(oldvals, suggest=suggest,
+                                                   completer=completer)
 
     # 3. just print if that was what was instructed on the cli
     if args.just_print:
@@ -176,8 +267,7 @@ def main(argv=None):
     # 6. Delete the original link if it was renamed (and the user allows)
     if newvals['deleteorig'] and origlink != newlinkname:
         print('Replacing %s with %s' % (origlink, newlinkname))
-        from pathlib import Path
-        Path(origlink).unlink()
+        fsops.remove(origlink)
 
 
 if '__main__' == __name__:
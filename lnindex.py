@@ -0,0 +1,796 @@
+#!/usr/bin/env python3
+"""
+Maintain a persistent, incrementally updated index of symlinks
+
+The index is a SQLite file recording every directory under the indexed
+roots along with its mtime, and every symlink along with its resolved
+target.  "update" stats each directory and only rescans the ones whose
+mtime changed since the last run, so a refresh costs one stat per
+directory rather than a full walk.  "dump" prints the same link<TAB>target
+table that lntable.py prints, and "query" answers "what links to X"
+from an index on the resolved target instead of grepping the table.
+
+Links in unchanged directories are re-resolved when the directory
+holding their target changed, when their target was under a removed
+directory, or when their target didn't resolve last time.  The one case
+this misses is a multi-hop chain whose intermediate link was retargeted;
+"update --full" re-resolves everything.
+
+Each directory also carries two hashes: one over the (link, target)
+entries directly in it, and one over every entry in its subtree.  Both
+are sums of per-entry hashes, so a change only adds its difference to
+the directory and its ancestors.  "snapshot" copies the index, and
+"diff" compares a snapshot with another one, or with the live tree, by
+descending only into directories whose subtree hashes differ.
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import stat
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+
+import lntable
+import pathcache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    path BLOB PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    path BLOB PRIMARY KEY,
+    parent BLOB,
+    mtime_ns INTEGER,
+    hash BLOB,
+    tree_hash BLOB
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS links (
+    link BLOB PRIMARY KEY,
+    dir BLOB,
+    value BLOB,
+    target BLOB,
+    target_dir BLOB
+);
+CREATE INDEX IF NOT EXISTS links_dir ON links (dir);
+CREATE INDEX IF NOT EXISTS links_target ON links (target);
+CREATE INDEX IF NOT EXISTS links_target_dir ON links (target_dir);
+"""
+
+
+def default_index_path():
+    cachedir = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'symlinkutil', 'lnindex.db')
+
+
+def _enc(path):
+    return os.fsencode(path)
+
+
+def _dec(blob):
+    return os.fsdecode(blob)
+
+
+HASH_BYTES = 16
+_HASH_MOD = 1 << (8 * HASH_BYTES)
+
+
+def link_hash(link, target):
+    """
+    What the encoded link and target add to the hashes of the link's
+    directory and its ancestors
+    """
+    return int.from_bytes(hashlib.blake2b(
+        link + b'\0' + target, digest_size=HASH_BYTES).digest(), 'big')
+
+
+def _hash_blob(value):
+    return (value % _HASH_MOD).to_bytes(HASH_BYTES, 'big')
+
+
+def _hash_int(blob):
+    return int.from_bytes(blob, 'big') if blob else 0
+
+
+def _subtree_range(path):
+    """
+    Return (path, lo, hi) such that "x = path OR (x >= lo AND x < hi)"
+    selects path and everything below it.  '0' is the byte after '/'.
+    """
+    path = _enc(path).rstrip(b'/')
+    return path, path + b'/', path + b'0'
+
+
+class UpdateStats(object):
+    """ Counters for what an update actually had to do """
+
+    def __init__(self):
+        self.rescanned = 0
+        self.skipped = 0
+        self.removed = 0
+        self.links = 0
+        self.reresolved = 0
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def report(self):
+        return ("dirs rescanned: {}, skipped: {}, removed: {}; "
+                "links rescanned: {}, re-resolved: {}; errors: {}; "
+                "{:.3f}s").format(
+                    self.rescanned, self.skipped, self.removed,
+                    self.links, self.reresolved, self.errors, self.elapsed)
+
+
+class LinkIndex(object):
+    """
+    A SQLite-backed symlink index.  Paths are stored as bytes (via
+    os.fsencode) so that undecodable filenames round-trip.
+    """
+
+    def __init__(self, filename=None, readonly=False):
+        self.filename = filename or default_index_path()
+        # tree hash deltas not yet written to dirs, by directory
+        self._pending = {}
+        if readonly:
+            # for snapshots and other users' indexes: no schema setup,
+            # migration or journal mode change, so the file is left as
+            # it was (sqlite3.Error if it can't be read)
+            self.db = sqlite3.connect(
+                'file:{}?mode=ro'.format(
+                    quote(os.path.abspath(self.filename))),
+                uri=True, timeout=5, check_same_thread=False)
+            self.db.execute("SELECT 1 FROM links LIMIT 1").fetchall()
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # lnwatch.py may be writing while lnlookup.sh reads; lnqueryd.py
+        # serializes its handler threads' use of the connection itself
+        self.db = sqlite3.connect(self.filename, timeout=60,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute(
+            "PRAGMA table_info(dirs)")]
+        if 'tree_hash' not in columns:
+            # an index from before the hashes
+            self.db.execute("ALTER TABLE dirs ADD COLUMN hash BLOB")
+            self.db.execute("ALTER TABLE dirs ADD COLUMN tree_hash BLOB")
+            self._rehash()
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def roots(self):
+        return [_dec(r) for r, in self.db.execute(
+            "SELECT path FROM roots ORDER BY path")]
+
+    def _load_dirs(self, root):
+        """
+        Return ({path: mtime_ns}, {parent: [subdirs]}) for the stored
+        directories under root, so that worker threads never touch the
+        database.
+        """
+        mtimes = {}
+        children = {}
+        query = self.db.execute(
+            "SELECT path, parent, mtime_ns FROM dirs "
+            "WHERE path = ? OR (path >= ? AND path < ?)", _subtree_range(root))
+        for path, parent, mtime_ns in query:
+            path = _dec(path)
+            mtimes[path] = mtime_ns
+            if parent is not None:
+                children.setdefault(_dec(parent), []).append(path)
+        return mtimes, children
+
+    def _propagate(self, path, delta):
+        """ Add delta to the tree hash of path and all its ancestors """
+        if not delta % _HASH_MOD:
+            return
+        pending = self._pending
+        while True:
+            pending[path] = (pending.get(path, 0) + delta) % _HASH_MOD
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+
+    def _flush_hashes(self):
+        """ Write the tree hash deltas collected by _propagate() """
+        for path, delta in self._pending.items():
+            row = self.db.execute("SELECT tree_hash FROM dirs WHERE path = ?",
+                                  (_enc(path),)).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE dirs SET tree_hash = ? WHERE path = ?",
+                    (_hash_blob(_hash_int(row[0]) + delta), _enc(path)))
+        self._pending.clear()
+
+    def _rehash(self):
+        """ Compute every directory's hashes from scratch """
+        own = {}
+        for link, linkdir, target in self.db.execute(
+                "SELECT link, dir, target FROM links"):
+            own[linkdir] = own.get(linkdir, 0) + link_hash(link, target)
+        self.db.execute("UPDATE dirs SET hash = ?, tree_hash = ?",
+                        (_hash_blob(0), _hash_blob(0)))
+        self.db.executemany("UPDATE dirs SET hash = ? WHERE path = ?",
+                            [(_hash_blob(value), path)
+                             for path, value in own.items()])
+        self._pending.clear()
+        for path, value in own.items():
+            self._propagate(_dec(path), value)
+        self._flush_hashes()
+
+    def _forget(self, path):
+        """ Drop path and everything below it from the index """
+        row = self.db.execute("SELECT tree_hash FROM dirs WHERE path = ?",
+                              (_enc(path),)).fetchone()
+        if row is not None:
+            tree = _hash_int(row[0]) + self._pending.pop(path, 0)
+            prefix = path.rstrip('/') + '/'
+            for stale in [p for p in self._pending if p.startswith(prefix)]:
+                del self._pending[stale]
+            if os.path.dirname(path) != path:
+                self._propagate(os.path.dirname(path), -tree)
+        path, lo, hi = _subtree_range(path)
+        cur = self.db.execute(
+            "DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, lo, hi))
+        self.db.execute(
+            "DELETE FROM links WHERE dir = ? OR (dir >= ? AND dir < ?)",
+            (path, lo, hi))
+        return cur.rowcount
+
+    def _reresolve(self, changed, removed, stats):
+        """
+        Re-resolve links whose targets may have been affected by the
+        directories that changed or disappeared in this update.
+        """
+        links = set()
+        for path in changed:
+            links.update(self.db.execute(
+                "SELECT link, dir, target FROM links WHERE target_dir = ?",
+                (_enc(path),)))
+        for path in removed:
+            links.update(self.db.execute(
+                "SELECT link, dir, target FROM links "
+                "WHERE target = ? OR (target >= ? AND target < ?)",
+                _subtree_range(path)))
+        links.update(self.db.execute(
+            "SELECT link, dir, target FROM links WHERE target = ?", (b'',)))
+        # links in directories we just rescanned are already fresh
+        fresh = set(_enc(path) for path in changed)
+        rows = []
+        deltas = {}
+        for link, linkdir, oldtarget in links:
+            if linkdir in fresh:
+                continue
+            target = _enc(lntable.readlink_f(_dec(link)))
+            rows.append((target, _enc(os.path.dirname(_dec(target))), link))
+            if target != oldtarget:
+                deltas[linkdir] = (deltas.get(linkdir, 0) +
+                                   link_hash(link, target) -
+                                   link_hash(link, oldtarget))
+        self.db.executemany(
+            "UPDATE links SET target = ?, target_dir = ? WHERE link = ?", rows)
+        for linkdir, delta in deltas.items():
+            self._adjust_hash(linkdir, delta)
+        stats.reresolved += len(rows)
+
+    def _adjust_hash(self, path, delta):
+        """ Add delta to the hash of the encoded directory path """
+        row = self.db.execute("SELECT hash FROM dirs WHERE path = ?",
+                              (path,)).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE dirs SET hash = ? WHERE path = ?",
+                            (_hash_blob(_hash_int(row[0]) + delta), path))
+            self._propagate(_dec(path), delta)
+
+    @staticmethod
+    def _scan(path):
+        """
+        Re-read one directory (in a pool_walk() worker).  Returns
+        ([(link, value, target), ...], subdirs).
+        """
+        rows = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_symlink():
+                        rows.append((entry.path,
+                                     pathcache.readlink(entry.path),
+                                     lntable.readlink_f(entry.path)))
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except OSError as err:
+                    lntable._report(err)
+        return rows, subdirs
+
+    def _store(self, path, parent, mtime_ns, rows):
+        """
+        Replace the stored links, mtime and hash for one rescanned
+        directory
+        """
+        encpath = _enc(path)
+        entries = [(_enc(link), encpath, _enc(value), _enc(target),
+                    _enc(os.path.dirname(target)))
+                   for link, value, target in rows]
+        own = sum(link_hash(entry[0], entry[3]) for entry in entries)
+        old = self.db.execute(
+            "SELECT hash, tree_hash FROM dirs WHERE path = ?",
+            (encpath,)).fetchone() or (None, None)
+        self.db.execute("DELETE FROM links WHERE dir = ?", (encpath,))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?)", entries)
+        self.db.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?, ?)",
+                        (encpath, parent and _enc(parent), mtime_ns,
+                         _hash_blob(own), _hash_blob(_hash_int(old[1]))))
+        self._propagate(path, own - _hash_int(old[0]))
+
+    def _update_tree(self, root, stats, changed, removed, full=False,
+                     jobs=1, one_file_system=False):
+        """
+        Walk root, rescanning directories whose mtime changed.  Appends
+        rescanned directories to changed and vanished ones to removed;
+        returns every directory visited.
+        """
+        mtimes, children = self._load_dirs(root)
+        errors = []
+        visited = []
+
+        def scan(path, st):
+            if not full and mtimes.get(path) == st.st_mtime_ns:
+                return None, children.get(path, [])
+            rows, subdirs = self._scan(path)
+            return (rows, subdirs), subdirs
+
+        def onerror(err):
+            lntable._report(err)
+            errors.append(err)
+
+        for path, st, result in lntable.pool_walk(root, scan, jobs,
+                                                  one_file_system, onerror):
+            if st is None:
+                stats.removed += self._forget(path)
+                removed.append(path)
+                continue
+            visited.append(path)
+            if result is None:
+                stats.skipped += 1
+            else:
+                rows, subdirs = result
+                stats.rescanned += 1
+                stats.links += len(rows)
+                self._store(path, os.path.dirname(path), st.st_mtime_ns,
+                            rows)
+                for gone in set(children.get(path, [])) - set(subdirs):
+                    stats.removed += self._forget(gone)
+                    removed.append(gone)
+                changed.append(path)
+        stats.errors += len(errors)
+        return visited
+
+    def update(self, root, full=False, jobs=1, one_file_system=False):
+        """
+        Bring the index for root up to date, rescanning only the
+        directories whose mtime has changed (or all of them if full).
+        Directories are stat'ed and scanned by a pool of jobs threads;
+        all database writes happen in the calling thread.
+        """
+        stats = UpdateStats()
+        start = time.perf_counter()
+        root = os.path.abspath(root)
+        self.db.execute("INSERT OR IGNORE INTO roots VALUES (?)",
+                        (_enc(root),))
+        changed = []
+        removed = []
+        self._update_tree(root, stats, changed, removed, full=full,
+                          jobs=jobs, one_file_system=one_file_system)
+        if not full:
+            self._reresolve(changed, removed, stats)
+        self._flush_hashes()
+        self.db.commit()
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+    def refresh(self, paths):
+        """
+        Rescan exactly the given directories (say, ones inotify reported
+        as changed), without walking below them.  Subdirectories that
+        appeared are indexed recursively.  Returns (stats, newdirs), where
+        newdirs lists every directory added to the index.
+        """
+        stats = UpdateStats()
+        start = time.perf_counter()
+        changed = []
+        removed = []
+        newdirs = []
+        for path in paths:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISDIR(st.st_mode):
+                stats.removed += self._forget(path)
+                removed.append(path)
+                continue
+            try:
+                rows, subdirs = self._scan(path)
+            except OSError as err:
+                lntable._report(err)
+                stats.errors += 1
+                continue
+            stats.rescanned += 1
+            stats.links += len(rows)
+            old = set(_dec(p) for p, in self.db.execute(
+                "SELECT path FROM dirs WHERE parent = ?", (_enc(path),)))
+            self._store(path, os.path.dirname(path), st.st_mtime_ns, rows)
+            changed.append(path)
+            for gone in old - set(subdirs):
+                stats.removed += self._forget(gone)
+                removed.append(gone)
+            for new in set(subdirs) - old:
+                newdirs.extend(self._update_tree(new, stats, changed,
+                                                 removed))
+        self._reresolve(changed, removed, stats)
+        self._flush_hashes()
+        self.db.commit()
+        stats.elapsed = time.perf_counter() - start
+        return stats, newdirs
+
+    def dirs(self, root):
+        """ Return every indexed directory under root """
+        return [_dec(p) for p, in self.db.execute(
+            "SELECT path FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            _subtree_range(os.path.abspath(root)))]
+
+    def iter_table(self, roots=None):
+        """ Yield (link, target) pairs, optionally limited to roots """
+        if not roots:
+            query = self.db.execute(
+                "SELECT link, target FROM links ORDER BY link")
+            for link, target in query:
+                yield _dec(link), _dec(target)
+            return
+        for root in roots:
+            path, lo, hi = _subtree_range(os.path.abspath(root))
+            query = self.db.execute(
+                "SELECT link, target FROM links "
+                "WHERE dir = ? OR (dir >= ? AND dir < ?) ORDER BY link",
+                (path, lo, hi))
+            for link, target in query:
+                yield _dec(link), _dec(target)
+
+    def entries(self, path):
+        """
+        Return {name: is a directory} for the indexed subdirectories
+        and symlinks directly in directory path, or None if path isn't
+        in the index.
+        """
+        path = _enc(os.path.abspath(path))
+        if self.db.execute("SELECT 1 FROM dirs WHERE path = ?",
+                           (path,)).fetchone() is None:
+            return None
+        names = dict((os.path.basename(_dec(link)), False) for link, in
+                     self.db.execute("SELECT link FROM links WHERE dir = ?",
+                                     (path,)))
+        names.update((os.path.basename(_dec(subdir)), True) for subdir, in
+                     self.db.execute("SELECT path FROM dirs WHERE parent = ?",
+                                     (path,)))
+        return names
+
+    def links_to(self, target):
+        """ Yield (link, target) for links resolving exactly to target """
+        query = self.db.execute(
+            "SELECT link, target FROM links WHERE target = ? ORDER BY link",
+            (_enc(target),))
+        for link, target in query:
+            yield _dec(link), _dec(target)
+
+    def links_under(self, prefix):
+        """
+        Yield (link, target) for links resolving to prefix or anywhere
+        below it.  This is a range scan on the target index.
+        """
+        query = self.db.execute(
+            "SELECT link, target FROM links "
+            "WHERE target = ? OR (target >= ? AND target < ?) "
+            "ORDER BY target, link", _subtree_range(prefix))
+        for link, target in query:
+            yield _dec(link), _dec(target)
+
+    def snapshot(self, filename):
+        """ Copy the index to filename, replacing what was there """
+        copy = sqlite3.connect(filename)
+        try:
+            self.db.backup(copy)
+            # a single file with no -wal/-shm, which a read-only open
+            # (as diff does) won't need to touch
+            copy.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            copy.close()
+
+    def _dir_hashes(self, path):
+        """ (hash, tree hash) of the encoded directory path, or None """
+        row = self.db.execute(
+            "SELECT hash, tree_hash FROM dirs WHERE path = ?",
+            (path,)).fetchone()
+        return row and (_hash_int(row[0]), _hash_int(row[1]))
+
+    def _child_hashes(self, path):
+        """ {subdirectory: tree hash} for the encoded directory path """
+        return dict((child, _hash_int(tree)) for child, tree in
+                    self.db.execute("SELECT path, tree_hash FROM dirs "
+                                    "WHERE parent = ?", (path,)))
+
+    def _dir_links(self, path):
+        """ {link: target} directly in the encoded directory path """
+        return dict(self.db.execute(
+            "SELECT link, target FROM links WHERE dir = ?", (path,)))
+
+
+def _top_roots(roots):
+    """ roots without the ones under another root """
+    tops = []
+    for root in sorted(set(roots)):
+        if not tops or not root.startswith(tops[-1].rstrip('/') + '/'):
+            tops.append(root)
+    return tops
+
+
+def diff(old, new, roots=None, stats=None):
+    """
+    Yield (link, oldtarget, newtarget) for every link that differs
+    between the LinkIndexes old and new under roots (by default, all of
+    either index's roots).  oldtarget is None for an added link and
+    newtarget is None for a removed one.  Only directories whose tree
+    hashes differ are read, so the work grows with the size of the
+    change.  If stats is a dict, stats['dirs'] counts directories read.
+    """
+    if stats is None:
+        stats = {}
+    stats.setdefault('dirs', 0)
+    roots = [os.path.abspath(root) for root in roots or
+             set(old.roots()) | set(new.roots())]
+    for root in _top_roots(roots):
+        stack = [_enc(root)]
+        while stack:
+            path = stack.pop()
+            stats['dirs'] += 1
+            oldhashes = old._dir_hashes(path)
+            newhashes = new._dir_hashes(path)
+            if oldhashes == newhashes:
+                continue
+            if oldhashes is None or newhashes is None:
+                # a whole subtree came or went
+                index = new if oldhashes is None else old
+                for link, target in index.iter_table([_dec(path)]):
+                    if oldhashes is None:
+                        yield link, None, target
+                    else:
+                        yield link, target, None
+                continue
+            if oldhashes[0] != newhashes[0]:
+                oldlinks = old._dir_links(path)
+                newlinks = new._dir_links(path)
+                for link in sorted(set(oldlinks) | set(newlinks)):
+                    oldtarget = oldlinks.get(link)
+                    newtarget = newlinks.get(link)
+                    if oldtarget != newtarget:
+                        yield (_dec(link),
+                               None if oldtarget is None else _dec(oldtarget),
+                               None if newtarget is None else _dec(newtarget))
+            oldkids = old._child_hashes(path)
+            newkids = new._child_hashes(path)
+            stack.extend(sorted(
+                (child for child in set(oldkids) | set(newkids)
+                 if oldkids.get(child) != newkids.get(child)),
+                reverse=True))
+
+
+def watcher_pidfile(filename):
+    """
+    Where lnwatch.py records "<pid> <mode>" and then its roots, one per
+    line, while it keeps filename fresh.  mode is "inotify" while its
+    watches keep the index current, and "starting", "rescanning" or
+    "polling" otherwise.
+    """
+    return filename + '.watch'
+
+
+def set_watcher_mode(filename, mode, roots):
+    """ Record this process as filename's watcher of roots, in mode """
+    pidfile = watcher_pidfile(filename)
+    with open(pidfile + '.tmp', 'w') as f:
+        f.write('{} {}\n'.format(os.getpid(), mode))
+        for root in roots:
+            f.write(root + '\n')
+    os.replace(pidfile + '.tmp', pidfile)
+
+
+def watched_roots(filename):
+    """
+    The roots an lnwatch.py process is keeping this index up to date
+    for through inotify (a polling one can be an --interval behind), or
+    an empty list if there's no such process
+    """
+    try:
+        with open(watcher_pidfile(filename)) as f:
+            lines = f.read().splitlines()
+        pid, mode = lines[0].split()
+        os.kill(int(pid), 0)
+    except (OSError, ValueError, IndexError):
+        return []
+    return lines[1:] if mode == 'inotify' else []
+
+
+def do_update(index, args):
+    roots = args.roots or index.roots() or [os.path.expanduser('~')]
+    watched = [] if args.full else watched_roots(index.filename)
+    for root in roots:
+        path = os.path.abspath(root)
+        if any(path == top or path.startswith(top.rstrip('/') + '/')
+               for top in watched):
+            if args.stats:
+                sys.stderr.write("{}: lnwatch is keeping it up to date; "
+                                 "skipping the rescan\n".format(root))
+            continue
+        stats = index.update(root, full=args.full, jobs=args.jobs,
+                             one_file_system=args.one_file_system)
+        if args.stats:
+            sys.stderr.write("{}: {}\n".format(root, stats.report()))
+    if args.stats:
+        sys.stderr.write(pathcache.report() + '\n')
+    return 0
+
+
+def do_dump(index, args):
+    lntable.write_table(index.iter_table(args.roots), sys.stdout.buffer)
+    sys.stdout.flush()
+    return 0
+
+
+def do_query(index, args):
+    target = lntable.readlink_f(args.target) or os.path.abspath(args.target)
+    if args.prefix:
+        rows = index.links_under(target)
+    else:
+        rows = index.links_to(target)
+    lntable.write_table(rows, sys.stdout.buffer)
+    sys.stdout.flush()
+    return 0
+
+
+def do_snapshot(index, args):
+    index.snapshot(args.snapshot)
+    return 0
+
+
+def do_diff(index, args):
+    for filename in (args.old, args.new):
+        if filename and not os.path.exists(filename):
+            sys.stderr.write("{}: no such index\n".format(filename))
+            return 2
+    # snapshots are baselines: don't let opening them change them
+    try:
+        old = LinkIndex(args.old, readonly=True)
+        new = args.new and LinkIndex(args.new, readonly=True)
+    except sqlite3.Error as err:
+        sys.stderr.write("can't read index: {}\n".format(err))
+        return 2
+    tmpdir = None
+    if not new:
+        # bring a copy of the snapshot up to date: only the directories
+        # whose mtime changed since the snapshot get rescanned
+        tmpdir = tempfile.mkdtemp(prefix='lnindex-')
+        old.snapshot(os.path.join(tmpdir, 'live.db'))
+        new = LinkIndex(os.path.join(tmpdir, 'live.db'))
+        for root in new.roots():
+            new.update(root, jobs=args.jobs)
+    stats = {}
+    counts = {'+': 0, '-': 0, '~': 0}
+    out = sys.stdout.buffer
+    try:
+        for link, oldtarget, newtarget in diff(old, new, args.roots, stats):
+            if oldtarget is None:
+                fields = ('+', link, newtarget)
+            elif newtarget is None:
+                fields = ('-', link, oldtarget)
+            else:
+                fields = ('~', link, oldtarget, newtarget)
+            counts[fields[0]] += 1
+            out.write(b'\t'.join(os.fsencode(f) for f in fields) + b'\n')
+        out.flush()
+    finally:
+        old.close()
+        new.close()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+    if args.stats:
+        sys.stderr.write("added: {}, removed: {}, retargeted: {}; "
+                         "directories compared: {}\n".format(
+                             counts['+'], counts['-'], counts['~'],
+                             stats['dirs']))
+    return 1 if any(counts.values()) else 0
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-i', '--index',
+                        help='index file (default: {})'.format(
+                            default_index_path()))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update = subparsers.add_parser(
+        'update', help='rescan directories that changed since the last run')
+    update.add_argument('--full', action='store_true',
+                        help='rescan every directory regardless of mtime')
+    update.add_argument('--stats', action='store_true',
+                        help='report rescanned/skipped directories on stderr')
+    update.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads')
+    update.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    update.add_argument('roots', nargs='*',
+                        help='directories to index (default: the roots '
+                        'already in the index, or $HOME)')
+    update.set_defaults(func=do_update)
+
+    dump = subparsers.add_parser(
+        'dump', help='print the link<TAB>target table')
+    dump.add_argument('roots', nargs='*',
+                      help='only print links under these directories')
+    dump.set_defaults(func=do_dump)
+
+    query = subparsers.add_parser(
+        'query', help='print the links that resolve to a given path')
+    query.add_argument('-p', '--prefix', action='store_true',
+                       help='also match links to anything under the path')
+    query.add_argument('target', help='path to look up (resolved with '
+                       'readlink -f semantics)')
+    query.set_defaults(func=do_query)
+
+    snapshot = subparsers.add_parser(
+        'snapshot', help='copy the index to a file, for diff')
+    snapshot.add_argument('snapshot', help='file to write the copy to')
+    snapshot.set_defaults(func=do_snapshot)
+
+    diffcmd = subparsers.add_parser(
+        'diff', help='print links added (+), removed (-) or retargeted (~) '
+        'between two snapshots, or a snapshot and the live tree')
+    diffcmd.add_argument('--stats', action='store_true',
+                         help='report counts and directories compared on '
+                         'stderr')
+    diffcmd.add_argument('-j', '--jobs', type=int, default=1,
+                         help='rescan the live tree with this many threads')
+    diffcmd.add_argument('-r', '--root', dest='roots', action='append',
+                         help='only compare under this directory '
+                         '(repeatable)')
+    diffcmd.add_argument('old', help='earlier snapshot')
+    diffcmd.add_argument('new', nargs='?',
+                         help='later snapshot (default: the live tree)')
+    diffcmd.set_defaults(func=do_diff)
+
+    args = parser.parse_args(argv)
+    index = LinkIndex(args.index)
+    try:
+        return args.func(index, args)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
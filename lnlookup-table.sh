@@ -1,16 +1,27 @@
 #!/bin/bash
 
 summary="$0: provide the table of links to lnlookup.sh"
-usageline="   usage: $0: [-q]"
-usageline="     -q  quick version - returns if there's no cache"
+usageline="   usage: $0: [-q] [-j jobs] [-r root]..."
+usageline="     -q  quick version - reuse the cache as-is rather than refreshing it"
+usageline="     -j  scan directories with this many threads"
+usageline="     -r  also cover this root (repeatable; or colon-separated in LNLOOKUP_ROOTS)"
 usage="${summary}\n\n${usageline}\n\n"
 
 fullhomedirflag=
 
-while getopts q flags
+jobs=1
+
+roots=()
+if [ -n "${LNLOOKUP_ROOTS}" ]; then
+  IFS=: read -r -a roots <<< "${LNLOOKUP_ROOTS}"
+fi
+
+while getopts qj:r: flags
 do
   case $flags in
     q)   quickflag=1;;
+    j)   jobs="$OPTARG";;
+    r)   roots+=("$OPTARG");;
     ?)   printf $usage
           exit 2;;
   esac
@@ -29,17 +40,35 @@ fi
 # using "cacheme", thus making this extra logic superfluous.  It is
 # nice having a temp file around, though, since I use the tempfile
 # every now and then.
+#
+# The table now comes from lnindex.py, which only rescans directories
+# whose mtime changed since the last run, so refreshing it is cheap
+# enough to do on every call.  The tempfile is rewritten from the index.
+#
+# With more roots than HOME (or once lnshards.py has shards), the table
+# comes from the shards instead: one per root, updated side by side,
+# plus any shards copied in from other hosts.
 
-if [ ! -e ${tmpfile} ]; then
-  if [ -z "$quickflag" ]; then
-    find ${HOME} -type l | while read LINE; do printf "${LINE}\t$(readlink -f ${LINE})\n"; done > ${tmpfile}
-    echo "lnlookup file created at ${tmpfile}" 1>&2
+bindir="$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")"
+shards="${XDG_CACHE_HOME:-${HOME}/.cache}/symlinkutil/shards"
+
+if [ -z "$quickflag" ]; then
+  if [ ${#roots[@]} -gt 0 ]; then
+    # (without roots, lnshards.py refreshes this host's existing shards)
+    roots=("${HOME}" "${roots[@]}")
+  fi
+  if [ ${#roots[@]} -gt 0 ] || compgen -G "${shards}/*.db" > /dev/null; then
+    "${bindir}/lnshards.py" update --stats -j "${jobs}" "${roots[@]}" &&
+      "${bindir}/lnshards.py" dump > ${tmpfile}
   else
-    echo "no ${tmpfile} found.  oops" 1>&2
+    "${bindir}/lnindex.py" update --stats -j "${jobs}" "${HOME}" &&
+      "${bindir}/lnindex.py" dump "${HOME}" > ${tmpfile}
   fi
+  echo "lnlookup file refreshed at ${tmpfile}" 1>&2
+elif [ ! -e ${tmpfile} ]; then
+  echo "no ${tmpfile} found.  oops" 1>&2
 else
   echo "using cached ${tmpfile}" 1>&2
 fi
 
 cat "${tmpfile}"
-
@@ -1,16 +1,22 @@
 #!/bin/bash
 
 summary="$0: find symlinks in HOMEDIR to a given path"
-usageline="   usage: $0: [-f] path"
+usageline="   usage: $0: [-f] [-p] [-q] path"
 usageline="     -f  full home dir rather than tilde"
+usageline="     -p  prefix: also find links to anything under path"
+usageline="     -q  quick: don't refresh the index first"
 usage="${summary}\n\n${usageline}\n\n"
 
 fullhomedirflag=
+queryflag=
+quickflag=
 
-while getopts f name
+while getopts fpq name
 do
   case $name in
     f)   fullhomedirflag=1;;
+    p)   queryflag=-p;;
+    q)   quickflag=1;;
     ?)   printf $usage
           exit 2;;
   esac
@@ -19,8 +25,17 @@ done
 # shift off the flags using arithmetic expansion of OPTIND
 shift $(($OPTIND - 1))
 
-lookuptable=lnlookup-table.sh
-ltcommand="cacheme $(dirname $(readlink -f ${BASH_SOURCE[0]}))/${lookuptable}"
+bindir="$(dirname "$(readlink -f "${BASH_SOURCE[0]}")")"
+lnindex="${bindir}/lnindex.py"
+shards="${XDG_CACHE_HOME:-${HOME}/.cache}/symlinkutil/shards"
+if compgen -G "${shards}/*.db" > /dev/null; then
+  # lnshards.py has per-root (and maybe other hosts') indexes: use them all
+  lnindex="${bindir}/lnshards.py"
+  updateroots=()
+else
+  updateroots=("${HOME}")
+fi
+querysock="${LNQUERYD_SOCKET:-${XDG_RUNTIME_DIR:-/tmp}/lnqueryd-${UID}.sock}"
 
 if [ ! -d ${HOME} ]; then
   echo "HOME variable is weird: ${HOME}"
@@ -35,7 +50,17 @@ fi
 if [ -e "$1" ]; then
   echo "$(${trimcmd} $(dirname .myxroot))/$1 links to $(${trimcmd} $1)"
   echo "Symlinks to $(${trimcmd} $1):"
-  grep "$(readlink -f $1)$" <($ltcommand) |
+  if [ -z "$quickflag" ]; then
+    "${lnindex}" update "${updateroots[@]}"
+  fi
+  if [ -S "${querysock}" ]; then
+    # lnqueryd.py is up: answer from its in-memory copy of the index
+    if [ -n "$queryflag" ]; then querycmd=under; else querycmd=links; fi
+    querytool=("${bindir}/lnquery.py" ${querycmd} "$1")
+  else
+    querytool=("${lnindex}" query ${queryflag} "$1")
+  fi
+  "${querytool[@]}" |
     while IFS=$'\t' read -a lnArray; do
       printf "$(${trimcmd} $(dirname ${lnArray[0]}))/$(basename ${lnArray[0]})\n"
     done
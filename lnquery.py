@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Ask lnqueryd.py about symlinks
+
+A thin client for the lnqueryd.py socket.  It deliberately imports
+nothing beyond os, socket and sys so that it starts about as fast as
+the interpreter does.  Exits 1 if nothing was found, 2 if the daemon
+isn't running or didn't understand the request.
+
+    lnquery.py lookup LINK       what LINK resolves to
+    lnquery.py links TARGET      links resolving to TARGET
+    lnquery.py under DIR         links resolving to anything under DIR
+    lnquery.py resolve PATH      PATH resolved like readlink -f
+"""
+
+import os
+import socket
+import sys
+
+COMMANDS = ('lookup', 'links', 'under', 'resolve')
+
+
+def socket_path():
+    # keep in step with lnqueryd.default_socket_path()
+    rundir = os.getenv('XDG_RUNTIME_DIR') or '/tmp'
+    return os.getenv('LNQUERYD_SOCKET') or os.path.join(
+        rundir, 'lnqueryd-{}.sock'.format(os.getuid()))
+
+
+def query(command, path, sockpath=None):
+    """
+    Send one request and return its answer lines.  Raises OSError if
+    the daemon can't be reached and ValueError if it rejects the request.
+    """
+    path = os.path.join(os.getenv('PWD') or os.getcwd(), path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sockpath or socket_path())
+        sock.sendall(command.encode() + b'\t' + os.fsencode(path) + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        answer = b''
+        while not answer.endswith(b'\n\n') and not answer.startswith(b'ERR'):
+            data = sock.recv(65536)
+            if not data:
+                break
+            answer += data
+    finally:
+        sock.close()
+    if answer.startswith(b'ERR'):
+        raise ValueError(os.fsdecode(answer.rstrip(b'\n')))
+    return [os.fsdecode(line) for line in answer.split(b'\n') if line]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2 or argv[0] not in COMMANDS:
+        sys.stderr.write(__doc__.split('\n\n')[-1].strip('\n') + '\n')
+        return 2
+    try:
+        lines = query(argv[0], argv[1])
+    except (OSError, ValueError) as err:
+        sys.stderr.write("lnquery: {}\n".format(err))
+        return 2
+    for line in lines:
+        sys.stdout.write(line + '\n')
+    return 0 if lines else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
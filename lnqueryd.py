@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Serve symlink lookups from memory over a Unix domain socket
+
+lnqueryd.py loads the link index (see lnindex.py) into a compact
+in-memory table (see linkstore.py) once and answers queries on a Unix
+socket, so lnlookup.sh and the shell helpers don't pay interpreter
+startup and index loading on every call.  It reloads the index
+whenever another process (lnindex.py update, lnwatch.py) commits a
+change to it, building the new table in the background and answering
+from the old one until it's ready.  With --shards it serves the merged
+shards of lnshards.py instead, reloading when any of them changes or
+one is added, removed or copied in from another host.
+
+The protocol is line based.  A request is a command and an absolute
+path separated by a tab:
+
+    lookup<TAB>/path/to/link       what the link resolves to
+    links<TAB>/path/to/target      links resolving exactly to the target
+    under<TAB>/path/to/dir         links resolving to anything under dir
+    resolve<TAB>/some/path         the path resolved like readlink -f
+
+Targets for links and under are resolved first, as "lnindex.py query"
+does.
+
+Answers are link<TAB>target lines (just the path, for resolve) followed
+by an empty line; errors are a single "ERR <message>" line instead.
+Several requests may be sent over one connection.  lnquery.py is the
+matching client.
+"""
+
+import argparse
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+import linkstore
+import lnindex
+import lntable
+import pathcache
+
+
+def default_socket_path():
+    rundir = os.getenv('XDG_RUNTIME_DIR') or '/tmp'
+    return os.getenv('LNQUERYD_SOCKET') or os.path.join(
+        rundir, 'lnqueryd-{}.sock'.format(os.getuid()))
+
+
+class IndexHolder(object):
+    """
+    Holds the current LinkStore.  When the index database has changed
+    since it was loaded, a new one is built in a background thread while
+    the old one goes on answering queries, and swapped in when done.
+    """
+
+    def __init__(self, filename):
+        self.index = lnindex.LinkIndex(filename)
+        self.lock = threading.Lock()
+        self.version = None
+        self.table = None
+        self.building = False
+
+    def _version(self):
+        return self.index.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _load(self):
+        """ Build a LinkStore, on a connection of its own """
+        index = lnindex.LinkIndex(self.index.filename, readonly=True)
+        try:
+            return linkstore.LinkStore(index.iter_table())
+        finally:
+            index.close()
+
+    def get(self):
+        with self.lock:
+            version = self._version()
+            if self.table is None:
+                # nothing to answer from yet, so this one has to wait
+                self.table = self._load()
+                self.version = version
+            elif version != self.version and not self.building:
+                self.building = True
+                threading.Thread(target=self._rebuild, args=(version,),
+                                 daemon=True).start()
+            return self.table
+
+    def _rebuild(self, version):
+        try:
+            table = self._load()
+        except Exception as err:
+            sys.stderr.write("lnqueryd: reload failed: {}\n".format(err))
+            table = None
+        with self.lock:
+            if table is not None:
+                # anything committed since version brings another rebuild
+                self.table = table
+                self.version = version
+            self.building = False
+
+
+class ShardHolder(IndexHolder):
+    """
+    IndexHolder for every shard in a directory (see lnshards.py),
+    reloading when a shard changes, appears or goes away.
+    """
+
+    def __init__(self, shard_dir):
+        import lnshards
+        self.index = lnshards.ShardSet(shard_dir)
+        self.lock = threading.Lock()
+        self.version = None
+        self.table = None
+        self.building = False
+
+    def _version(self):
+        return self.index.version()
+
+    def _load(self):
+        import lnshards
+        shards = lnshards.ShardSet(self.index.shard_dir)
+        try:
+            return linkstore.LinkStore(shards.iter_table())
+        finally:
+            shards.close()
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                command, path = os.fsdecode(line.rstrip(b'\n')).split('\t', 1)
+                answer = self.server.answer(command, path)
+            except ValueError:
+                answer = None
+            if answer is None:
+                self.wfile.write(b'ERR bad request\n')
+            else:
+                self.wfile.write(b''.join(
+                    os.fsencode(row) + b'\n' for row in answer) + b'\n')
+            self.wfile.flush()
+
+
+class QueryServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketpath, holder):
+        self.holder = holder
+        super(QueryServer, self).__init__(socketpath, QueryHandler)
+
+    def answer(self, command, path):
+        """ Return the answer lines for one request, or None if it's bad """
+        if not os.path.isabs(path):
+            return None
+        if command != 'lookup':
+            # a cache of its own: the filesystem may have changed since
+            # the last request, and other handler threads are resolving
+            # paths at the same time
+            path = lntable.readlink_f(path, pathcache.ResolveCache())
+        if command == 'resolve':
+            return [path]
+        table = self.holder.get()
+        if command == 'lookup':
+            rows = table.lookup(os.path.normpath(path))
+        elif command == 'links':
+            rows = table.links_to(path)
+        elif command == 'under':
+            rows = table.links_under(path)
+        else:
+            return None
+        return ['{}\t{}'.format(link, target) for link, target in rows]
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-i', '--index',
+                        help='index file (default: {})'.format(
+                            lnindex.default_index_path()))
+    parser.add_argument('-s', '--socket',
+                        help='socket path (default: {})'.format(
+                            default_socket_path()))
+    parser.add_argument('--shards', metavar='DIR', nargs='?', const='',
+                        help='serve every shard in DIR (see lnshards.py; '
+                        'default: its shard directory) instead of one '
+                        'index')
+    args = parser.parse_args(argv)
+
+    socketpath = args.socket or default_socket_path()
+    if os.path.exists(socketpath):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socketpath)
+        except OSError:
+            # left behind by a daemon that didn't get to clean up
+            os.remove(socketpath)
+        else:
+            sys.stderr.write("lnqueryd: already serving on {}\n".format(
+                socketpath))
+            return 1
+        finally:
+            probe.close()
+    if args.shards is not None:
+        holder = ShardHolder(args.shards or None)
+    else:
+        holder = IndexHolder(args.index)
+    sys.stderr.write("loaded {} links\n".format(len(holder.get())))
+    # bind with owner-only permissions from the start
+    oldmask = os.umask(0o077)
+    try:
+        server = QueryServer(socketpath, holder)
+    finally:
+        os.umask(oldmask)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socketpath)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Re-point every symlink under a tree from one target prefix to another
+
+e.g. after a volume moves from /old/mount to /new/mount:
+
+    lnretarget.py -n ~ /old/mount /new/mount   # show what would change
+    lnretarget.py ~ /old/mount /new/mount      # do it
+
+Targets are matched lexically (the old prefix doesn't need to exist any
+more).  Relative links stay relative and absolute links stay absolute.
+Each link is rewritten atomically, relative to its open directory (see
+dirfd.py).  The tree is scanned once, a directory at a time, so memory
+use doesn't grow with the number of links.
+"""
+
+import argparse
+import os
+import sys
+
+import dirfd
+import lntable
+
+
+def retarget_value(linkdir, value, oldprefix, newprefix):
+    """
+    Return the new value for a symlink in linkdir whose current value is
+    value, or None if it doesn't point into oldprefix.  oldprefix and
+    newprefix must be normalized absolute paths.
+    """
+    target = os.path.normpath(os.path.join(linkdir, value))
+    if target != oldprefix and not target.startswith(oldprefix + os.sep):
+        return None
+    newtarget = newprefix + target[len(oldprefix):]
+    if os.path.isabs(value):
+        return newtarget
+    return os.path.relpath(newtarget, linkdir)
+
+
+def iter_rewrites(root, oldprefix, newprefix, jobs=1, one_file_system=False):
+    """
+    Yield (link, oldvalue, newvalue) for every symlink under root that
+    points into oldprefix.
+    """
+    oldprefix = os.path.normpath(os.path.abspath(oldprefix))
+    newprefix = os.path.normpath(os.path.abspath(newprefix))
+
+    def scan(path, st):
+        rewrites = []
+        subdirs = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_symlink():
+                        value = os.readlink(entry.path)
+                        newvalue = retarget_value(path, value,
+                                                  oldprefix, newprefix)
+                        if newvalue is not None:
+                            rewrites.append((entry.path, value, newvalue))
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                except OSError as err:
+                    lntable._report(err)
+        return rewrites, subdirs
+
+    # relative values are resolved by the kernel against the physical
+    # directory, so walk from the physical root
+    root = os.path.realpath(root)
+    for path, st, rewrites in lntable.pool_walk(root, scan, jobs,
+                                                one_file_system):
+        if rewrites:
+            yield from rewrites
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help='print the rewrites without doing them')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rewrite links even if the new target '
+                        'doesn\'t exist')
+    parser.add_argument('-b', '--backup', action='store_true',
+                        help='save a tilde backup of each rewritten symlink')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    parser.add_argument('root', help='tree to scan for symlinks')
+    parser.add_argument('oldprefix', help='target prefix to move away from')
+    parser.add_argument('newprefix', help='target prefix to move to')
+    args = parser.parse_args(argv)
+
+    rewritten = 0
+    failed = 0
+    out = sys.stdout.buffer
+    # a directory's rewrites come out together, so each directory is
+    # only opened once
+    dirs = dirfd.DirCache()
+    for link, value, newvalue in iter_rewrites(args.root, args.oldprefix,
+                                               args.newprefix, args.jobs,
+                                               args.one_file_system):
+        if not args.dry_run:
+            try:
+                directory, name = dirs.split(link)
+                directory.make_the_move(name, newvalue,
+                                        allowbroken=args.force,
+                                        savebackup=args.backup)
+            except OSError as err:
+                failed += 1
+                sys.stderr.write("{}: {}: {}\n".format(
+                    link, err.strerror or 'not found', newvalue))
+                continue
+        rewritten += 1
+        out.write(b'\t'.join(os.fsencode(p) for p in (link, value, newvalue))
+                  + b'\n')
+    dirs.close()
+    out.flush()
+    sys.stderr.write("{} {} link(s), {} failed\n".format(
+        'would rewrite' if args.dry_run else 'rewrote', rewritten, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,371 @@
+#!/usr/bin/env python3
+"""
+Keep the symlink index as one shard per root, and query them together
+
+Each shard is an ordinary lnindex.py index file covering one root on
+one host, named "<quoted root>@<host>.db" in the shard directory.
+Shards are updated independently, and several at once (each in its own
+process), so one volume can be rebuilt, or refreshed on its own
+schedule, without touching the others:
+
+    lnshards.py update ~ /srv/media /mnt/shared   # one shard per root
+    lnshards.py update --split-mounts /           # one per mount point
+
+After an update a shard is left as a single self-contained file (no
+-wal or -shm), so shards can be copied between hosts as plain files,
+e.g.
+
+    rsync otherhost:.cache/symlinkutil/shards/*@otherhost.db \\
+        ~/.cache/symlinkutil/shards/
+
+"dump" and "query" fan out over every shard in the directory,
+whichever host built it, and merge the sorted results.  They open
+shards read-only, so copies from other hosts (and read-only shard
+directories) are left as they are.  "update" with no roots refreshes
+this host's shards.
+"""
+
+import argparse
+import collections
+import heapq
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import quote, unquote
+
+import lnindex
+import lntable
+
+
+def default_shard_dir():
+    cachedir = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'symlinkutil', 'shards')
+
+
+def this_host():
+    return socket.gethostname().split('.')[0]
+
+
+class Shard(collections.namedtuple('Shard', 'filename root host')):
+    __slots__ = ()
+
+
+def shard_filename(shard_dir, root, host=None):
+    """ Where the shard for root on host (default: this one) lives """
+    return os.path.join(shard_dir, '{}@{}.db'.format(
+        quote(os.path.abspath(root), safe=''), host or this_host()))
+
+
+def find_shards(shard_dir=None):
+    """ Return the Shards in shard_dir, sorted by root and host """
+    shard_dir = shard_dir or default_shard_dir()
+    shards = []
+    try:
+        names = os.listdir(shard_dir)
+    except FileNotFoundError:
+        return shards
+    for name in names:
+        quoted, at, host = name[:-len('.db')].rpartition('@')
+        if name.endswith('.db') and at and quoted:
+            shards.append(Shard(os.path.join(shard_dir, name),
+                                unquote(quoted), host))
+    return sorted(shards, key=lambda shard: (shard.root, shard.host))
+
+
+# kernel filesystems with no symlinks worth indexing
+VIRTUAL_FS = {'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2',
+              'configfs', 'debugfs', 'devpts', 'devtmpfs', 'fusectl',
+              'hugetlbfs', 'mqueue', 'proc', 'pstore', 'securityfs',
+              'sysfs', 'tracefs'}
+
+
+def mount_roots(root):
+    """ root, followed by every (real) mount point below it """
+    root = os.path.abspath(root)
+    prefix = root.rstrip('/') + '/'
+    roots = [root]
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3 or fields[2] in VIRTUAL_FS:
+                    continue
+                # spaces and such in mount points are octal escapes
+                mountpoint = re.sub(r'\\([0-7]{3})',
+                                    lambda m: chr(int(m.group(1), 8)),
+                                    fields[1])
+                if mountpoint.startswith(prefix) and mountpoint not in roots:
+                    roots.append(mountpoint)
+    except OSError:
+        pass
+    return roots
+
+
+def update_shard(filename, root, full=False, jobs=1, one_file_system=False):
+    """
+    Bring one shard up to date (in a worker process).  Returns the
+    lnindex UpdateStats report.
+    """
+    index = lnindex.LinkIndex(filename)
+    try:
+        stats = index.update(root, full=full, jobs=jobs,
+                             one_file_system=one_file_system)
+        # fold the write-ahead log back in and drop it, so the .db file
+        # alone is a complete copy of the shard, and read-only opens
+        # don't need a -wal or -shm next to it
+        index.db.execute("PRAGMA journal_mode=DELETE")
+        return stats.report()
+    finally:
+        index.close()
+
+
+def _unique(rows):
+    """ Drop rows equal to the one before (shards may overlap) """
+    last = None
+    for row in rows:
+        if row != last:
+            yield row
+        last = row
+
+
+class ShardSet(object):
+    """
+    Every shard in a directory, opened together.  Queries go to all of
+    them in parallel and come back merged in the order a single index
+    would give.  refresh() picks up shards that were added, removed or
+    replaced (say, by a copy from another host) since they were opened.
+    """
+
+    def __init__(self, shard_dir=None):
+        self.shard_dir = shard_dir or default_shard_dir()
+        self.lock = threading.Lock()
+        self.indexes = collections.OrderedDict()
+        self._inodes = {}
+        self._executor = None
+        self._workers = 0
+        self.refresh()
+
+    def refresh(self):
+        with self.lock:
+            shards = find_shards(self.shard_dir)
+            current = set()
+            for shard in shards:
+                try:
+                    inode = os.stat(shard.filename).st_ino
+                except OSError:
+                    continue
+                current.add(shard.filename)
+                if self._inodes.get(shard.filename) != inode:
+                    if shard.filename in self.indexes:
+                        self.indexes.pop(shard.filename).close()
+                    # even if it won't open: don't retry (and complain
+                    # again) until the file is replaced
+                    self._inodes[shard.filename] = inode
+                    try:
+                        self.indexes[shard.filename] = lnindex.LinkIndex(
+                            shard.filename, readonly=True)
+                    except sqlite3.Error as err:
+                        sys.stderr.write("{}: {}\n".format(shard.filename,
+                                                           err))
+            for filename in set(self._inodes) - current:
+                self._inodes.pop(filename)
+                if filename in self.indexes:
+                    self.indexes.pop(filename).close()
+
+    def version(self):
+        """
+        Something that changes whenever the merged contents may have:
+        the shard files and each one's SQLite data_version
+        """
+        self.refresh()
+        with self.lock:
+            return tuple((filename, self._inodes[filename],
+                          index.db.execute(
+                              "PRAGMA data_version").fetchone()[0])
+                         for filename, index in self.indexes.items())
+
+    def close(self):
+        with self.lock:
+            while self.indexes:
+                self.indexes.popitem()[1].close()
+            self._inodes.clear()
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _fanout(self, query, key):
+        """ Run query(index) on every shard at once, merging by key """
+        with self.lock:
+            indexes = list(self.indexes.values())
+            if len(indexes) > 1 and (
+                    self._executor is None or
+                    self._workers < len(indexes)):
+                # one pool for the life of the set; starting threads
+                # costs more than most lookups
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                self._workers = len(indexes)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self._workers)
+            executor = self._executor
+        if len(indexes) < 2:
+            results = [list(query(index)) for index in indexes]
+        else:
+            results = list(executor.map(lambda index: list(query(index)),
+                                        indexes))
+        return _unique(heapq.merge(*results, key=key))
+
+    def iter_table(self, roots=None):
+        """ Yield (link, target) pairs from every shard, by link """
+        # LinkIndex.iter_table() sorts each root separately, so merge
+        # one stream per shard and root
+        runs = [index.iter_table([root] if root else None)
+                for index in self.indexes.values()
+                for root in (roots or [None])]
+        return _unique(heapq.merge(*runs,
+                                   key=lambda row: os.fsencode(row[0])))
+
+    def links_to(self, target):
+        return self._fanout(lambda index: index.links_to(target),
+                            lambda row: os.fsencode(row[0]))
+
+    def links_under(self, prefix):
+        return self._fanout(lambda index: index.links_under(prefix),
+                            lambda row: (os.fsencode(row[1]),
+                                         os.fsencode(row[0])))
+
+
+def do_update(args):
+    host = this_host()
+    roots = args.roots or [shard.root for shard in find_shards(args.dir)
+                           if shard.host == host] or [os.path.expanduser('~')]
+    one_file_system = args.one_file_system
+    if args.split_mounts:
+        roots = [mount for root in roots for mount in mount_roots(root)]
+        # each mount point is its own shard, so don't also walk into it
+        one_file_system = True
+    # overlapping roots and mount lists name some roots twice; two
+    # workers writing one shard would just repeat each other's work
+    roots = list(dict.fromkeys(os.path.realpath(root) for root in roots))
+    os.makedirs(args.dir, exist_ok=True)
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+        futures = [(root, executor.submit(
+            update_shard, shard_filename(args.dir, root, host), root,
+            args.full, args.jobs, one_file_system)) for root in roots]
+        for root, future in futures:
+            try:
+                report = future.result()
+            except Exception as err:
+                failed += 1
+                sys.stderr.write("{}: {}\n".format(root, err))
+                continue
+            if args.stats:
+                sys.stderr.write("{}: {}\n".format(root, report))
+    return 1 if failed else 0
+
+
+def do_dump(args):
+    shards = ShardSet(args.dir)
+    try:
+        lntable.write_table(shards.iter_table(args.roots), sys.stdout.buffer)
+    finally:
+        shards.close()
+    sys.stdout.flush()
+    return 0
+
+
+def do_query(args):
+    target = lntable.readlink_f(args.target) or os.path.abspath(args.target)
+    shards = ShardSet(args.dir)
+    try:
+        if args.prefix:
+            rows = shards.links_under(target)
+        else:
+            rows = shards.links_to(target)
+        lntable.write_table(rows, sys.stdout.buffer)
+    finally:
+        shards.close()
+    sys.stdout.flush()
+    return 0
+
+
+def do_list(args):
+    for shard in find_shards(args.dir):
+        try:
+            index = lnindex.LinkIndex(shard.filename, readonly=True)
+        except sqlite3.Error as err:
+            sys.stderr.write("{}: {}\n".format(shard.filename, err))
+            continue
+        try:
+            links, = index.db.execute("SELECT COUNT(*) FROM links").fetchone()
+        finally:
+            index.close()
+        print("{}\t{}\t{}\t{}".format(shard.host, shard.root, links,
+                                      os.path.getsize(shard.filename)))
+    return 0
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-d', '--dir', default=default_shard_dir(),
+                        help='shard directory (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update = subparsers.add_parser(
+        'update', help="build or refresh the shards for some roots")
+    update.add_argument('--full', action='store_true',
+                        help='rescan every directory regardless of mtime')
+    update.add_argument('--stats', action='store_true',
+                        help='report what each shard update did on stderr')
+    update.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads per '
+                        'shard')
+    update.add_argument('-P', '--parallel', type=int,
+                        default=os.cpu_count() or 1,
+                        help='update this many shards at once (default: '
+                        '%(default)s)')
+    update.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    update.add_argument('--split-mounts', action='store_true',
+                        help='give every mount point under the roots a '
+                        'shard of its own')
+    update.add_argument('roots', nargs='*',
+                        help="roots to index (default: this host's "
+                        'existing shards, or $HOME)')
+    update.set_defaults(func=do_update)
+
+    dump = subparsers.add_parser(
+        'dump', help='print the link<TAB>target table of every shard')
+    dump.add_argument('roots', nargs='*',
+                      help='only print links under these directories')
+    dump.set_defaults(func=do_dump)
+
+    query = subparsers.add_parser(
+        'query', help='print the links in any shard that resolve to a path')
+    query.add_argument('-p', '--prefix', action='store_true',
+                       help='also match links to anything under the path')
+    query.add_argument('target', help='path to look up (resolved with '
+                       'readlink -f semantics)')
+    query.set_defaults(func=do_query)
+
+    listing = subparsers.add_parser(
+        'list', help='print host, root, links and size of every shard')
+    listing.set_defaults(func=do_list)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except BrokenPipeError:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
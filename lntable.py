@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Print a tab-separated table of symlinks and their resolved targets
+
+This is an in-process replacement for the find/readlink loop that
+lnlookup-table.sh used to run:
+
+    find ${HOME} -type l | while read LINE; do
+        printf "${LINE}\\t$(readlink -f ${LINE})\\n"
+    done
+
+The output format is the same (one "link<TAB>target" line per symlink),
+but the tree is walked with os.scandir and each target is resolved
+without forking readlink.  With -j N, directories are scanned by a pool
+of N threads; the output is then in completion order rather than find
+order.
+"""
+
+import argparse
+import concurrent.futures
+import os
+import stat
+import sys
+import threading
+
+import pathcache
+
+
+def readlink_f(path, cache=None):
+    """
+    Resolve path the way GNU "readlink -f" does: every component but the
+    last must exist.  Returns the empty string where readlink -f would
+    print nothing (dangling parent directory, symlink loop).  Readlinks
+    go through cache (default: pathcache's shared one).
+    """
+    cache = cache or pathcache.default_cache
+    try:
+        return cache.realpath(path, strict=True)
+    except FileNotFoundError:
+        resolved = cache.realpath(path)
+        if os.path.isdir(os.path.dirname(resolved)):
+            return resolved
+        return ''
+    except OSError:
+        return ''
+
+
+def _report(err):
+    sys.stderr.write("{}: {}: '{}'\n".format(
+        os.path.basename(sys.argv[0]), err.strerror, err.filename))
+
+
+def walk_links(top, onerror=_report):
+    """
+    Yield the path of every symlink under top, in the same order that
+    "find top -type l" would print them.  Symlinked directories are not
+    descended into.
+    """
+    if os.path.islink(top):
+        yield top
+        return
+    try:
+        stack = [os.scandir(top)]
+    except OSError as err:
+        if onerror is not None:
+            onerror(err)
+        return
+    while stack:
+        try:
+            entry = next(stack[-1])
+        except StopIteration:
+            stack.pop().close()
+            continue
+        except OSError as err:
+            stack.pop().close()
+            if onerror is not None:
+                onerror(err)
+            continue
+        try:
+            if entry.is_symlink():
+                yield entry.path
+            elif entry.is_dir(follow_symlinks=False):
+                stack.append(os.scandir(entry.path))
+        except OSError as err:
+            if onerror is not None:
+                onerror(err)
+
+
+def pool_walk(top, scan, jobs=1, one_file_system=False, onerror=_report):
+    """
+    Walk the directories under top, fanning out over a pool of jobs
+    threads.  scan(path, st) is called in a worker for each directory and
+    returns (result, subdirs); this generator yields (path, st, result)
+    in completion order.  A directory that vanished or stopped being a
+    directory is yielded as (path, None, None).
+
+    Each directory is visited once per (st_dev, st_ino), so bind-mount
+    loops aren't followed twice; with one_file_system, directories on a
+    different device than top are skipped (like "find -xdev").
+    """
+    visited = set()
+    lock = threading.Lock()
+    rootdev = None
+    if one_file_system:
+        try:
+            rootdev = os.lstat(top).st_dev
+        except OSError as err:
+            onerror(err)
+            return
+
+    def visit(path):
+        """ Returns (path, st, result, subdirs), or None to skip path """
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            return path, None, None, []
+        except OSError as err:
+            onerror(err)
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            return path, None, None, []
+        if rootdev is not None and st.st_dev != rootdev:
+            return None
+        with lock:
+            if (st.st_dev, st.st_ino) in visited:
+                return None
+            visited.add((st.st_dev, st.st_ino))
+        try:
+            result, subdirs = scan(path, st)
+        except OSError as err:
+            onerror(err)
+            return None
+        return path, st, result, subdirs
+
+    if jobs <= 1:
+        stack = [top]
+        while stack:
+            visited_dir = visit(stack.pop())
+            if visited_dir is not None:
+                path, st, result, subdirs = visited_dir
+                stack.extend(reversed(subdirs))
+                yield path, st, result
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        pending = {executor.submit(visit, top)}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                visited_dir = future.result()
+                if visited_dir is None:
+                    continue
+                path, st, result, subdirs = visited_dir
+                pending.update(executor.submit(visit, subdir)
+                               for subdir in subdirs)
+                yield path, st, result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def scan_links(path, st=None):
+    """
+    pool_walk() scanner: return ([(link, target), ...], subdirs) for
+    the symlinks and subdirectories directly inside path.
+    """
+    rows = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_symlink():
+                    rows.append((entry.path, readlink_f(entry.path)))
+                elif entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError as err:
+                _report(err)
+    return rows, subdirs
+
+
+def iter_table(tops, jobs=1, one_file_system=False):
+    """ Yield (link, resolved target) pairs for every symlink under tops """
+    for top in tops:
+        if jobs <= 1 and not one_file_system:
+            for link in walk_links(top):
+                yield link, readlink_f(link)
+        elif os.path.islink(top):
+            yield top, readlink_f(top)
+        else:
+            for path, st, rows in pool_walk(top, scan_links, jobs,
+                                            one_file_system):
+                if rows:
+                    yield from rows
+
+
+def write_table(rows, outfile):
+    """
+    Write (link, target) rows to a binary file object.  Paths are encoded
+    with os.fsencode so that undecodable filenames survive the trip.
+    """
+    for link, target in rows:
+        outfile.write(os.fsencode(link) + b'\t' + os.fsencode(target) + b'\n')
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('roots', nargs='*',
+                        help='directories to scan (default: $HOME)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='scan directories with this many threads')
+    parser.add_argument('-x', '--one-file-system', action='store_true',
+                        help="don't descend into other filesystems")
+    args = parser.parse_args(argv)
+
+    roots = args.roots or [os.path.expanduser('~')]
+    try:
+        write_table(iter_table(roots, args.jobs, args.one_file_system),
+                    sys.stdout.buffer)
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # e.g. "lntable.py | head"; don't spew a traceback
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
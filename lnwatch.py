@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Keep the symlink index live by watching its directories with inotify
+
+lnwatch.py brings the index (see lnindex.py) up to date once, puts an
+inotify watch on every indexed directory, and then rescans just the
+directories that report entries being created, deleted or renamed.
+Retargeting a symlink always shows up as one of those, since a symlink
+can't be changed in place.  While its watches are in place,
+"lnindex.py update" on the watched roots is a no-op, so lnlookup.sh
+queries pay no scan time.
+
+If the inotify watch limit (fs.inotify.max_user_watches) runs out, it
+falls back to an incremental "lnindex.py update" every --interval
+seconds (and "lnindex.py update" scans again, since the index may be
+that far behind).  See lnwatch.service for running it under systemd.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import signal
+import struct
+import sys
+import time
+
+import lnindex
+import pathcache
+
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    """ Minimal ctypes wrapper around the inotify syscalls """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        self.fd = self._check(self._libc.inotify_init1(IN_NONBLOCK |
+                                                       IN_CLOEXEC))
+
+    @staticmethod
+    def _check(ret, path=None):
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return ret
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        return self._check(self._libc.inotify_add_watch(
+            self.fd, os.fsencode(path), mask), path)
+
+    def read(self, timeout=None):
+        """ Yield (wd, mask, name) per pending event, waiting up to timeout """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            buf = os.read(self.fd, 1024 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    """ Maps inotify events onto LinkIndex.refresh() calls """
+
+    def __init__(self, index, roots, interval=300, debounce=0.2,
+                 verbose=False):
+        self.index = index
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.interval = interval
+        self.debounce = debounce
+        self.verbose = verbose
+        self.inotify = None
+        self.paths = {}
+
+    def log(self, message):
+        if self.verbose:
+            sys.stderr.write(message + '\n')
+
+    def set_mode(self, mode):
+        """ Tell "lnindex.py update" whether it can skip its scan """
+        lnindex.set_watcher_mode(self.index.filename, mode, self.roots)
+
+    def _watch(self, path):
+        self.paths[self.inotify.add_watch(path)] = path
+
+    def _watch_all(self, paths):
+        """ Watch paths; returns False if the watch limit ran out """
+        try:
+            for path in paths:
+                try:
+                    self._watch(path)
+                except FileNotFoundError:
+                    pass
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                raise
+            sys.stderr.write("lnwatch: out of inotify watches ({} in use); "
+                             "falling back to rescanning every {}s\n".format(
+                                 len(self.paths), self.interval))
+            self.inotify.close()
+            self.inotify = None
+            return False
+        return True
+
+    def update_all(self):
+        # the changes we're reacting to were made behind pathcache's back
+        pathcache.default_cache.clear()
+        for root in self.roots:
+            self.log("{}: {}".format(root, self.index.update(root).report()))
+
+    def poll_forever(self):
+        self.set_mode('polling')
+        while True:
+            time.sleep(self.interval)
+            self.update_all()
+
+    def _unwatched(self):
+        """ Indexed directories under the roots without a watch yet """
+        watched = set(self.paths.values())
+        return [d for root in self.roots for d in self.index.dirs(root)
+                if d not in watched]
+
+    def run(self):
+        # watch before scanning, so that changes made while the scan
+        # runs queue up as events for the loop below
+        self.inotify = Inotify()
+        if not self._watch_all(self._unwatched()):
+            self.update_all()
+            return self.poll_forever()
+        self.update_all()
+        # directories the scan found that weren't indexed before: one
+        # changed before its watch went on has a new mtime, which a
+        # second incremental update picks up
+        newdirs = self._unwatched()
+        if newdirs:
+            if not self._watch_all(newdirs):
+                return self.poll_forever()
+            self.update_all()
+        self.log("watching {} directories".format(len(self.paths)))
+        self.set_mode('inotify')
+        while True:
+            dirty = set()
+            overflow = False
+            timeout = None
+            # gather events until things go quiet for a moment
+            while True:
+                events = list(self.inotify.read(timeout))
+                if not events:
+                    break
+                timeout = self.debounce
+                for wd, mask, name in events:
+                    if mask & IN_Q_OVERFLOW:
+                        overflow = True
+                        continue
+                    path = self.paths.get(wd)
+                    if path is None:
+                        continue
+                    if mask & IN_IGNORED:
+                        del self.paths[wd]
+                        dirty.add(os.path.dirname(path))
+                    elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                        dirty.add(os.path.dirname(path))
+                    else:
+                        dirty.add(path)
+            if overflow:
+                self.log("event queue overflowed; rescanning")
+                self.set_mode('rescanning')
+                self.update_all()
+                self.set_mode('inotify')
+                continue
+            dirty = [path for path in dirty if self._covered(path)]
+            pathcache.default_cache.clear()
+            stats, newdirs = self.index.refresh(sorted(dirty))
+            self.log("{} dir(s) changed: {}".format(len(dirty),
+                                                     stats.report()))
+            if not self._watch_all(newdirs):
+                return self.poll_forever()
+
+    def _covered(self, path):
+        return any(path == root or path.startswith(root + os.sep)
+                   for root in self.roots)
+
+
+def main(argv=None):
+    # using splitlines to just get the first line
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-i', '--index',
+                        help='index file (default: {})'.format(
+                            lnindex.default_index_path()))
+    parser.add_argument('--interval', type=float, default=300,
+                        help='seconds between rescans if inotify watches '
+                        'run out (default: 300)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='log what gets rescanned to stderr')
+    parser.add_argument('roots', nargs='*',
+                        help='directories to watch (default: the roots '
+                        'already in the index, or $HOME)')
+    args = parser.parse_args(argv)
+
+    index = lnindex.LinkIndex(args.index)
+    roots = args.roots or index.roots() or [os.path.expanduser('~')]
+    pidfile = lnindex.watcher_pidfile(index.filename)
+    lnindex.set_watcher_mode(index.filename, 'starting',
+                             [os.path.abspath(root) for root in roots])
+    # let systemd's SIGTERM unwind through the finally below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Watcher(index, roots, interval=args.interval,
+                verbose=args.verbose).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.remove(pidfile)
+        index.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""
+A shared, memoizing path resolver
+
+os.path.realpath() lstats every component of every path it resolves,
+and tools that resolve many links in the same directories end up
+asking the kernel the same questions over and over.  This module keeps
+an LRU cache of what each path component is (a symlink and its value,
+something else, or missing) and resolves paths against it.
+
+Anything that changes a path on disk must call invalidate() on it.
+The module-level realpath/readlink/invalidate functions use one shared
+cache; set PATHCACHE_STATS=1 in the environment to have its hit/miss
+counters printed to stderr at exit.
+"""
+
+import atexit
+import errno
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import fsops
+
+# what a probed path turned out to be, besides a symlink value
+_NOTLINK = object()
+_MISSING = object()
+
+
+class ResolveCache(object):
+    """
+    LRU cache of readlink() results keyed by absolute path, with a
+    realpath() implementation (a port of posixpath.realpath) on top.
+    """
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _probe(self, path):
+        """
+        Return the symlink value of absolute path, _NOTLINK, or
+        _MISSING.  One readlink(2) on a miss: EINVAL means "not a link".
+        """
+        with self._lock:
+            try:
+                found = self._entries[path]
+            except KeyError:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return found
+        try:
+            found = fsops.readlink(path)
+        except OSError as err:
+            found = _NOTLINK if err.errno == errno.EINVAL else _MISSING
+        with self._lock:
+            self._entries[path] = found
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return found
+
+    def readlink(self, path):
+        """ Cached os.readlink() """
+        path = os.fspath(path)
+        found = self._probe(os.path.join(os.getcwd(), path))
+        if found is _NOTLINK:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), path)
+        if found is _MISSING:
+            # rerun the real thing for an accurate error
+            return fsops.readlink(path)
+        return found
+
+    def realpath(self, path, strict=False):
+        """ Cached os.path.realpath(), including strict= semantics """
+        path = os.fspath(path)
+        if not os.path.isabs(path):
+            path = os.path.join(os.getcwd(), path)
+        resolved, ok = self._joinrealpath('/', path, strict, {})
+        return os.path.abspath(resolved)
+
+    def _joinrealpath(self, path, rest, strict, seen):
+        # follows posixpath._joinrealpath, with _probe() standing in
+        # for lstat+readlink
+        if os.path.isabs(rest):
+            rest = rest[1:]
+            path = '/'
+        while rest:
+            name, _, rest = rest.partition('/')
+            if not name or name == '.':
+                continue
+            if name == '..':
+                path, name = os.path.split(path)
+                if name == '..':
+                    path = os.path.join(path, '..', '..')
+                continue
+            newpath = os.path.join(path, name)
+            found = self._probe(newpath)
+            if found is _MISSING and strict:
+                fsops.lstat(newpath)
+            if found is _NOTLINK or found is _MISSING:
+                path = newpath
+                continue
+            if newpath in seen:
+                path = seen[newpath]
+                if path is not None:
+                    continue
+                if strict:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP),
+                                  newpath)
+                return os.path.join(newpath, rest), False
+            seen[newpath] = None
+            path, ok = self._joinrealpath(path, found, strict, seen)
+            if not ok:
+                return os.path.join(path, rest), False
+            seen[newpath] = path
+        return path, True
+
+    def invalidate(self, path, subtree=False, realparent=None):
+        """
+        Forget what is known about path (and, with subtree, everything
+        below it).  Call this after creating, removing, renaming or
+        retargeting path; pass subtree=True when path is a directory
+        that moved.  Callers that already know realpath() of path's
+        directory can pass it as realparent to save resolving it.
+        """
+        path = os.path.normpath(os.path.join(os.getcwd(), os.fspath(path)))
+        parent, name = os.path.split(path)
+        if realparent is None:
+            realparent = self.realpath(parent)
+        keys = {path, os.path.join(realparent, name)}
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.invalidations += 1
+            if subtree:
+                prefixes = tuple(key.rstrip('/') + '/' for key in keys)
+                stale = [k for k in self._entries if k.startswith(prefixes)]
+                for k in stale:
+                    del self._entries[k]
+                self.invalidations += len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def report(self):
+        total = self.hits + self.misses
+        return ("pathcache: {} hits, {} misses ({:.1f}% hit rate), "
+                "{} evictions, {} invalidations").format(
+                    self.hits, self.misses,
+                    100.0 * self.hits / total if total else 0.0,
+                    self.evictions, self.invalidations)
+
+
+default_cache = ResolveCache()
+realpath = default_cache.realpath
+readlink = default_cache.readlink
+invalidate = default_cache.invalidate
+
+
+def report():
+    return default_cache.report()
+
+
+if os.getenv('PATHCACHE_STATS'):
+    atexit.register(lambda: sys.stderr.write(report() + '\n'))
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import errno
+import json
 import os
-import shutil
+import stat
 import sys
-from os.path import realpath, normpath
+from os.path import normpath
+
+import dirfd
+import fsops
+import pathcache
+from pathcache import realpath
 
 
 def confirm_step(prompt):
@@ -48,15 +55,282 @@ def swapln(oldhome, newhome, forsure=False, relative=False):
     debugoutput += "  1-symtarg) {}\n".format(symtarg)
     if forsure:
         debugoutput += "performing action....\n"
-        os.remove(newhome)
-        shutil.move(oldhome, newhome)
-        os.symlink(symtarg, oldhome)
+        fsops.remove(newhome)
+        fsops.move(oldhome, newhome)
+        fsops.symlink(symtarg, oldhome)
+        pathcache.invalidate(newhome, subtree=True)
+        pathcache.invalidate(oldhome, subtree=True)
     else:
         debugoutput += "haven't done it yet...\n"
     return {"debugoutput" : debugoutput,
             "symtarg": symtarg}
 
 
+def default_journal_path():
+    cachedir = os.getenv('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cachedir, 'symlinkutil', 'swapln.journal')
+
+
+def read_pairs(infile):
+    """
+    Read swaps from a batch file: "oldhome<TAB>newhome" per line, or
+    just the path of a symlink to swap (like the symfile argument).
+    """
+    pairs = []
+    realpwd = realpath(os.getenv('PWD') or os.getcwd())
+    for line in infile:
+        fields = line.rstrip('\n').split('\t')
+        if not fields[0] or fields[0].startswith('#'):
+            continue
+        if len(fields) > 1:
+            pairs.append((os.path.abspath(fields[0]),
+                          os.path.abspath(fields[1])))
+        else:
+            pairs.append((realpath(fields[0]),
+                          normpath(os.path.join(realpwd, fields[0]))))
+    return pairs
+
+
+def plan_batch(pairs, relative=False):
+    """
+    Check every swap's preconditions up front, with one lstat per path.
+    Returns (plan, problems): plan is a list of dicts describing each
+    swap, including the old value of the newhome symlink so that it can
+    be put back by a rollback.
+    """
+    plan = []
+    problems = []
+    seen = set()
+    for oldhome, newhome in pairs:
+        for path in (oldhome, newhome):
+            if path in seen:
+                problems.append("{} appears in more than one swap".format(
+                    path))
+            seen.add(path)
+        try:
+            oldst = fsops.lstat(oldhome)
+            newst = fsops.lstat(newhome)
+        except OSError as err:
+            problems.append("{}: {}".format(err.filename, err.strerror))
+            continue
+        if stat.S_ISLNK(oldst.st_mode):
+            problems.append("{} is already a symlink".format(oldhome))
+            continue
+        if not stat.S_ISLNK(newst.st_mode):
+            problems.append("{} isn't a symlink".format(newhome))
+            continue
+        symtarg = swapln(oldhome, newhome, relative=relative)['symtarg']
+        plan.append({'oldhome': oldhome, 'newhome': newhome,
+                     'symtarg': symtarg,
+                     'origlink': pathcache.readlink(newhome)})
+    return plan, problems
+
+
+class Journal(object):
+    """
+    Append-only JSON-lines record of a batch swap.  Each record is
+    fsync'ed before the step it describes is considered done.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname:
+            fsops.makedirs(dirname, exist_ok=True)
+        self.f = open(filename, 'a')
+
+    def write(self, **record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+        fsops.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def read(filename):
+        """ Return (plan, finished op or None) from a journal file """
+        plan = None
+        finished = None
+        with open(filename) as f:
+            for line in f:
+                record = json.loads(line)
+                if record.get('op') == 'begin':
+                    plan = record['plan']
+                    finished = None
+                elif record.get('op') in ('commit', 'rollback'):
+                    finished = record['op']
+        return plan, finished
+
+
+# Each step checks whether it has already happened, so a batch that
+# died between doing a step and journaling it can be resumed or rolled
+# back by simply running the steps again.
+
+def _move(src, dst, dirs):
+    """ Rename src to dst through the DirCache dirs, copying across devices """
+    srcdir, srcname = dirs.split(src)
+    dstdir, dstname = dirs.split(dst)
+    try:
+        srcdir.rename(srcname, dstdir, dstname)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        fsops.move(src, dst)
+    dirs.invalidate(src)
+    dirs.invalidate(dst)
+
+
+def _apply_swap(swap, dirs):
+    olddir, oldname = dirs.split(swap['oldhome'])
+    newdir, newname = dirs.split(swap['newhome'])
+    if newdir.islink(newname):
+        newdir.remove(newname)
+    if not newdir.lexists(newname):
+        _move(swap['oldhome'], swap['newhome'], dirs)
+    if not olddir.lexists(oldname):
+        olddir.symlink(swap['symtarg'], oldname)
+    pathcache.invalidate(swap['newhome'], subtree=True)
+    pathcache.invalidate(swap['oldhome'], subtree=True)
+
+
+def _undo_swap(swap, dirs):
+    olddir, oldname = dirs.split(swap['oldhome'])
+    newdir, newname = dirs.split(swap['newhome'])
+    if (olddir.islink(oldname) and
+            olddir.readlink(oldname) == swap['symtarg']):
+        olddir.remove(oldname)
+    if (not olddir.lexists(oldname) and newdir.lexists(newname) and
+            not newdir.islink(newname)):
+        _move(swap['newhome'], swap['oldhome'], dirs)
+    if not newdir.lexists(newname):
+        newdir.symlink(swap['origlink'], newname)
+    pathcache.invalidate(swap['newhome'], subtree=True)
+    pathcache.invalidate(swap['oldhome'], subtree=True)
+
+
+def run_batch(plan, journalfile, start=0):
+    """ Apply the planned swaps from index start on, journaling each """
+    journal = Journal(journalfile)
+    dirs = dirfd.DirCache()
+    try:
+        if start == 0:
+            journal.write(op='begin', plan=plan)
+        for i, swap in enumerate(plan[start:], start):
+            journal.write(op='start', index=i)
+            try:
+                _apply_swap(swap, dirs)
+            except OSError as err:
+                # for batch_main() to say where the batch stopped
+                err.swap = swap
+                raise
+            journal.write(op='done', index=i)
+            print("{} -> {}".format(swap['oldhome'], swap['symtarg']))
+        journal.write(op='commit')
+    finally:
+        dirs.close()
+        journal.close()
+
+
+def resume_batch(journalfile):
+    """ Finish a batch that was interrupted; returns the swaps redone """
+    plan, finished = Journal.read(journalfile)
+    if plan is None or finished:
+        return 0
+    done = set()
+    with open(journalfile) as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get('op') == 'begin':
+                done = set()
+            elif record.get('op') == 'done':
+                done.add(record['index'])
+    start = 0
+    while start in done:
+        start += 1
+    run_batch(plan, journalfile, start=start)
+    return len(plan) - start
+
+
+def rollback_batch(journalfile):
+    """ Undo every swap in a journal, last first """
+    plan, finished = Journal.read(journalfile)
+    if plan is None or finished == 'rollback':
+        return 0
+    journal = Journal(journalfile)
+    dirs = dirfd.DirCache()
+    try:
+        for i, swap in reversed(list(enumerate(plan))):
+            try:
+                _undo_swap(swap, dirs)
+            except OSError as err:
+                err.swap = swap
+                raise
+            journal.write(op='undone', index=i)
+        journal.write(op='rollback')
+    finally:
+        dirs.close()
+        journal.close()
+    return len(plan)
+
+
+def batch_main(args):
+    journalfile = args.journal or default_journal_path()
+    try:
+        return _batch_main(args, journalfile)
+    except OSError as err:
+        swap = getattr(err, 'swap', None)
+        if swap is None:
+            raise
+        print("{} stopped at {} <-> {}: {}".format(
+            'rollback' if args.rollback else 'batch', swap['oldhome'],
+            swap['newhome'], err), file=sys.stderr)
+        print("the batch is unfinished; its journal is {}".format(
+            journalfile), file=sys.stderr)
+        print("fix the problem and run swapln --resume, or undo the batch "
+              "with swapln --rollback", file=sys.stderr)
+        return 1
+
+
+def _batch_main(args, journalfile):
+    if args.resume:
+        print("resumed {} swap(s)".format(resume_batch(journalfile)))
+        return 0
+    if args.rollback:
+        print("rolled back {} swap(s)".format(rollback_batch(journalfile)))
+        return 0
+
+    if fsops.exists(journalfile):
+        plan, finished = Journal.read(journalfile)
+        if plan is not None and not finished:
+            print("{} holds an unfinished batch; use --resume or "
+                  "--rollback".format(journalfile))
+            return 1
+
+    if args.batch == '-':
+        pairs = read_pairs(sys.stdin)
+    else:
+        with open(args.batch) as f:
+            pairs = read_pairs(f)
+    plan, problems = plan_batch(pairs, relative=args.relative)
+    if problems:
+        for problem in problems:
+            print(problem)
+        print("nothing swapped")
+        return 1
+    for swap in plan:
+        print('{} <-> {}'.format(swap['oldhome'], swap['newhome']))
+    if not args.force:
+        if args.batch == '-' or not confirm_step(
+                'swap all {}?'.format(len(plan))):
+            print("well, nevermind then")
+            return 1
+    if fsops.exists(journalfile):
+        fsops.remove(journalfile)
+    run_batch(plan, journalfile)
+    return 0
+
+
 def main(argv=None):
     """ Make PWD the symlink target, symlinking the old target back """
 
@@ -71,13 +345,32 @@ def main(argv=None):
     parser.add_argument('-v', '--verbose',
                         help='print a lot to stdout',
                         action="store_true")
+    parser.add_argument('--batch', metavar='FILE',
+                        help='swap every "oldhome<TAB>newhome" pair (or '
+                        'symlink) listed in FILE ("-" for stdin; needs -f)')
+    parser.add_argument('--journal',
+                        help='batch journal file (default: {})'.format(
+                            default_journal_path()))
+    parser.add_argument('--resume', action='store_true',
+                        help='finish an interrupted batch from its journal')
+    parser.add_argument('--rollback', action='store_true',
+                        help='undo a batch (finished or not) from its journal')
+    parser.add_argument('--profile', action='store_true',
+                        help='print counts and times of filesystem calls '
+                        'to stderr at exit')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a JSON line per filesystem call to FILE')
     parser.add_argument('symfile', help='optional symlink to swap',
                         nargs='?', default=None)
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    fsops.start(args.profile, args.trace)
+
+    if args.batch or args.resume or args.rollback:
+        return batch_main(args)
 
     if args.symfile:
         try:
-            oldhome = realpath(os.readlink(args.symfile))
+            oldhome = realpath(pathcache.readlink(args.symfile))
         except OSError:
             print("'{}' is not a valid symlink".format(args.symfile))
             sys.exit()
@@ -106,5 +399,5 @@ def main(argv=None):
 
 
 if __name__ == '__main__':
-    exit_status = main(sys.argv)
+    exit_status = main()
     sys.exit(exit_status)
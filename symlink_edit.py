@@ -0,0 +1,322 @@
+"""
+The non-UI half of lnedit: read a symlink, and rewrite it atomically
+"""
+
+# Copyright (c) 2019 Rob Lanphier
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation
+# files (the "Software"), to deal in the Software without
+# restriction, including without limitation the rights to use,
+# copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following
+# conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+# OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+# WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+# OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import stat
+import threading
+
+import fsops
+import pathcache
+
+
+def get_userroot():
+    userroot = pathcache.realpath(pathcache.readlink(".userroot"))
+    userroot = os.getenv('USERROOT')
+    return userroot
+
+
+def read_link_values(linkfile, allowbroken, savebackup):
+    """
+    The part of get_values_from_link() that takes a single readlink, so
+    that the UI can come up before the suggestions are worked out.
+    """
+    return {'origlink': linkfile,
+            'targetref': pathcache.readlink(linkfile),
+            'allowbroken': allowbroken,
+            'savebackup': savebackup}
+
+
+def get_values_from_link(linkfile, allowbroken, savebackup):
+    """
+    Read a symlink at the given linkfile, and return a dict for passing
+    into the UI.
+    """
+
+    retval = {}
+    # first add the core data:
+
+    retval['origlink'] = linkfile
+    symlinkvalue = pathcache.readlink(linkfile)
+    retval['targetref'] = symlinkvalue
+
+    # suggestion #1 - absolute path
+    abspath = pathcache.realpath(linkfile)
+    retval['suggestion-abspath'] = abspath
+
+    # suggestion #2 - relative path to linkfile location
+    realpwd = pathcache.realpath(os.getenv('PWD'))
+    if os.path.isabs(symlinkvalue):
+        newhome = os.path.normpath(os.path.join(realpwd, symlinkvalue))
+        abspath_dir = os.path.dirname(abspath)
+        symtarg_relpath = os.path.relpath(newhome, abspath_dir)
+    else:
+        newhome = os.path.normpath(os.path.join(realpwd, symlinkvalue))
+        linkvalpwd = os.path.join(realpwd, os.path.dirname(linkfile))
+        symtarg_relpath = os.path.relpath(abspath, linkvalpwd)
+    retval['suggestion-relpath'] = symtarg_relpath
+
+    # suggestion #3 - .userroot alternative
+    try:
+        rel_to_userroot = os.path.relpath(abspath, get_userroot())
+        symtarg_userroot = os.path.join('.userroot', rel_to_userroot)
+    except FileNotFoundError:
+        symtarg_userroot = ""
+    retval['suggestion-userroot'] = symtarg_userroot
+
+    # add parameters that were passed in
+    retval['allowbroken'] = allowbroken
+    retval['savebackup'] = savebackup
+
+    return retval
+
+
+def _split_dir(path, cache):
+    """ os.path.abspath(path) as a list of components, memoized """
+    try:
+        return cache[path]
+    except KeyError:
+        if not path:
+            # what relpath() says about an empty start
+            raise ValueError("no path specified")
+        parts = cache[path] = [x for x in os.path.abspath(path).split('/')
+                               if x]
+        return parts
+
+
+def _relpath(parts, startparts):
+    """ os.path.relpath() on paths already split by _split_dir() """
+    i = 0
+    n = min(len(parts), len(startparts))
+    while i < n and parts[i] == startparts[i]:
+        i += 1
+    rel = ['..'] * (len(startparts) - i) + parts[i:]
+    return '/'.join(rel) if rel else os.curdir
+
+
+def get_values_from_links(linkfiles, allowbroken, savebackup):
+    """
+    get_values_from_link() for many links at once, returning a list of
+    the same dicts.  PWD and .userroot are resolved once for the whole
+    batch, and each directory is split into components only once, so
+    the relative-path suggestions for a whole tree cost a comparison of
+    component lists per link.  Raises like get_values_from_link() does
+    if any linkfile isn't a readable symlink.
+    """
+    realpwd = pathcache.realpath(os.getenv('PWD'))
+    try:
+        userroot = get_userroot()
+        if userroot is None:
+            userroot = os.curdir
+    except FileNotFoundError:
+        userroot = None
+    splits = {}
+
+    results = []
+    for linkfile in linkfiles:
+        symlinkvalue = pathcache.readlink(linkfile)
+        abspath = pathcache.realpath(linkfile)
+        absparts = _split_dir(abspath, splits)
+        if os.path.isabs(symlinkvalue):
+            relpath = _relpath(
+                _split_dir(os.path.normpath(symlinkvalue), splits),
+                absparts[:-1])
+        else:
+            relpath = _relpath(absparts, _split_dir(
+                os.path.join(realpwd, os.path.dirname(linkfile)), splits))
+        if userroot is None:
+            symtarg_userroot = ""
+        else:
+            symtarg_userroot = os.path.join(
+                '.userroot', _relpath(absparts, _split_dir(userroot, splits)))
+        results.append({
+            'origlink': linkfile,
+            'targetref': symlinkvalue,
+            'suggestion-abspath': abspath,
+            'suggestion-relpath': relpath,
+            'suggestion-userroot': symtarg_userroot,
+            'allowbroken': allowbroken,
+            'savebackup': savebackup,
+        })
+    return results
+
+
+def check_target(linkfile, targetref):
+    """
+    Preview what linkfile would point at with targetref as its value.
+    Returns a dict with the resolved target ('abspath'), the value as a
+    path relative to the link's directory ('relpath'), and 'status':
+    'directory', 'file', 'broken' (a symlink that doesn't resolve) or
+    'missing'.  This touches the filesystem, so the UI calls it from a
+    background thread.
+    """
+    linkdir = pathcache.realpath(os.path.dirname(os.path.abspath(linkfile)))
+    target = os.path.join(linkdir, targetref)
+    try:
+        st = fsops.stat(target)
+        status = 'directory' if stat.S_ISDIR(st.st_mode) else 'file'
+    except OSError:
+        status = 'broken' if fsops.lexists(target) else 'missing'
+    abspath = pathcache.realpath(target)
+    return {'targetref': targetref,
+            'abspath': abspath,
+            'relpath': os.path.relpath(abspath, linkdir),
+            'status': status}
+
+
+class TargetCompleter(object):
+    """
+    Tab completion of symlink targets.  A directory's names come from
+    the cache of directories already listed, then from the symlink
+    index (which knows a directory's subdirectories and symlinks, but
+    not its files), and only then from listing the directory.  Safe to
+    call from a background thread.
+    """
+
+    def __init__(self, indexfile=None):
+        self.indexfile = indexfile
+        self.listings = {}
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _from_index(self, directory):
+        if not self.indexfile:
+            return None
+        import sqlite3
+        import lnindex
+        try:
+            if self._index is None:
+                # read-only: the index may be a snapshot or someone
+                # else's, and this runs on a keystroke
+                self._index = lnindex.LinkIndex(self.indexfile,
+                                                readonly=True)
+            return self._index.entries(directory)
+        except sqlite3.Error:
+            # missing, unreadable or locked: list the directory instead
+            return None
+
+    def list(self, directory):
+        """ List directory into the cache, returning {name: is a dir} """
+        names = {}
+        with fsops.scandir(directory) as it:
+            for entry in it:
+                try:
+                    names[entry.name] = entry.is_dir()
+                except OSError:
+                    names[entry.name] = False
+        with self._lock:
+            self.listings[directory] = names
+        return names
+
+    def names(self, directory):
+        """
+        Return ({name: is a dir}, listed) for directory, where listed
+        is False if the names came from the index and may be missing
+        files.
+        """
+        with self._lock:
+            names = self.listings.get(directory)
+        if names is not None:
+            return names, True
+        names = self._from_index(directory)
+        if names is not None:
+            return names, False
+        try:
+            return self.list(directory), True
+        except OSError:
+            return {}, True
+
+    def complete(self, linkfile, text):
+        """
+        Complete the target value text for linkfile as far as it's
+        unambiguous.  Returns (newtext, matching names, directory,
+        listed) where listed is as for names().
+        """
+        linkdir = pathcache.realpath(
+            os.path.dirname(os.path.abspath(linkfile)))
+        dirpart, base = os.path.split(text)
+        directory = os.path.normpath(os.path.join(linkdir, dirpart))
+        names, listed = self.names(directory)
+        matches = sorted(name for name in names if name.startswith(base) and
+                         (base.startswith('.') or not name.startswith('.')))
+        if not matches:
+            return text, matches, directory, listed
+        newtext = os.path.join(dirpart, os.path.commonprefix(matches))
+        if len(matches) == 1 and names[matches[0]]:
+            newtext += '/'
+        return newtext, matches, directory, listed
+
+
+def replace_symlink(target, linkname):
+    """
+    Point linkname at target without linkname ever going missing: make
+    the new symlink under a unique temporary name in the same directory,
+    then rename(2) it over linkname.
+    """
+    dirname, basename = os.path.split(linkname)
+    while True:
+        tmpname = os.path.join(dirname, '.{}.{}.tmp'.format(
+            basename, os.urandom(4).hex()))
+        try:
+            fsops.symlink(target, tmpname)
+            break
+        except FileExistsError:
+            continue
+    try:
+        fsops.replace(tmpname, linkname)
+    except OSError:
+        fsops.remove(tmpname)
+        raise
+    finally:
+        pathcache.invalidate(linkname)
+
+
+def make_the_move(origlink, newlinkname, newtargetref, allowbroken=False, savebackup=False):
+    """
+    Point newlinkname at newtargetref, replacing any symlink already
+    there in one atomic rename.  With savebackup, the old link is first
+    copied to newlinkname + "~".
+    """
+    backupname = newlinkname + "~"
+
+    # relative targets are relative to the link, not to the cwd
+    target_exists = fsops.exists(
+        os.path.join(os.path.dirname(newlinkname), newtargetref))
+    if not (target_exists or allowbroken):
+        raise FileNotFoundError(newtargetref)
+    retval = ""
+    if fsops.islink(newlinkname):
+        if savebackup:
+            replace_symlink(pathcache.readlink(newlinkname), backupname)
+            retval += "Backup {} saved.\n".format(backupname)
+    elif fsops.lexists(newlinkname):
+        # don't clobber a real file or directory
+        raise FileExistsError(newlinkname)
+    replace_symlink(newtargetref, newlinkname)
+    retval += "{} -> {}".format(newlinkname, newtargetref)
+    if not target_exists:
+        retval += "\nNOTE: {} doesn't appear to exist.".format(newtargetref)
+    return retval
@@ -22,14 +22,19 @@
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
 # OTHER DEALINGS IN THE SOFTWARE.
 
+import os
+import threading
+
 import urwid
 #import lnedit.errors
 
 from collections import OrderedDict
 
+from symlink_edit import check_target
+
 FIELD_DEFS = [
     ['origlink', 'Link name', 'text', ''],
-    ['targetref', 'Target value', 'text', ''],
+    ['targetref', 'Target value', 'target', ''],
     ['allowbroken', 'Force writing broken symlink? (-f)', 'checkbox', False],
     ['savebackup',
         'Save tilde backup of edited symlink? (-b)', 'checkbox', False],
@@ -67,6 +72,8 @@ class FieldManager(object):
     def __init__(self, defaults):
         self.fieldset = OrderedDict()
         self.getters = {}
+        self.setters = {}
+        self.assistant = None
         for i, d in enumerate(FIELD_DEFS):
             key = d[0]
             self.fieldset[key] = {}
@@ -89,6 +96,21 @@ class FieldManager(object):
         """
         self.getters[name] = function
 
+    def set_setter(self, name, function):
+        """
+        Fields whose value can change after the form is drawn register
+        a function to display a new value here.
+        """
+        self.setters[name] = function
+
+    def set_value(self, name, value):
+        """
+        Change the value of a field while the form is up.
+        """
+        self.fieldset[name]['default'] = value
+        if name in self.setters:
+            self.setters[name](value)
+
     def get_value(self, name):
         """
         This will actually get the value associated with a field name.
@@ -114,7 +136,19 @@ def get_field(fieldname, fielddef, fieldmgr):
     colon = urwid.Text(('label', ': '))
 
     defaultval = fieldmgr.get_value(fieldname)
-    if fielddef['type'] == 'text':
+    if fielddef['type'] == 'target':
+        assistant = fieldmgr.assistant
+        edit = TargetEdit('', defaultval, assistant=assistant)
+        status = urwid.Text(('status', ''))
+        field = urwid.Pile([edit, status])
+        if assistant is not None:
+            assistant.edit = edit
+            assistant.status = status
+            urwid.connect_signal(
+                edit, 'postchange',
+                lambda widget, old: assistant.changed(widget.get_edit_text()))
+        fieldmgr.set_getter(fieldname, edit.get_edit_text)
+    elif fielddef['type'] == 'text':
         field = urwid.Edit('', defaultval)
 
         def getter():
@@ -126,6 +160,8 @@ def get_field(fieldname, fielddef, fieldmgr):
         fieldmgr.set_getter(fieldname, getter)
     elif fielddef['type'] == 'readonlytext':
         field = urwid.Text(('label', defaultval))
+        fieldmgr.set_setter(
+            fieldname, lambda value, f=field: f.set_text(('label', value)))
     elif fielddef['type'] == 'checkbox':
         field = urwid.CheckBox('', defaultval)
 
@@ -194,6 +230,173 @@ class AdvancingListBox(urwid.ListBox):
             return key
 
 
+class BackgroundJob(object):
+    """
+    Run func(arg) in a daemon thread for the most recently submitted
+    arg (ones superseded while it was busy are dropped), and hand
+    (arg, result) to deliver() back in the urwid main loop, through a
+    pipe from MainLoop.watch_pipe().  If func raises, result is the
+    exception.  deliver may be None for jobs run only for their effect.
+    """
+    _IDLE = object()
+
+    def __init__(self, loop, func, deliver=None):
+        self.func = func
+        self.deliver = deliver
+        self._arg = self._IDLE
+        self._results = []
+        self._cond = threading.Condition()
+        self._pipe = loop.watch_pipe(self._wake)
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+
+    def submit(self, arg):
+        with self._cond:
+            self._arg = arg
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._arg is self._IDLE:
+                    self._cond.wait()
+                arg, self._arg = self._arg, self._IDLE
+            try:
+                result = self.func(arg)
+            except Exception as err:
+                result = err
+            with self._cond:
+                self._results.append((arg, result))
+            os.write(self._pipe, b'.')
+
+    def _wake(self, data):
+        with self._cond:
+            results, self._results = self._results, []
+        if self.deliver is not None:
+            for arg, result in results:
+                self.deliver(arg, result)
+        return True
+
+
+class TargetEdit(urwid.Edit):
+    """ The target value field: tab asks the assistant to complete it """
+
+    def __init__(self, *args, **kwargs):
+        self.assistant = kwargs.pop('assistant', None)
+        super(TargetEdit, self).__init__(*args, **kwargs)
+
+    def keypress(self, size, key):
+        if key == 'tab' and self.assistant is not None:
+            self.assistant.complete(self.get_edit_text())
+            return None
+        return super(TargetEdit, self).keypress(size, key)
+
+
+class TargetAssistant(object):
+    """
+    Everything in the form that touches the filesystem, done off the
+    main loop: checking the target value as it's typed, tab completion,
+    and filling in the suggestions.  get_field() supplies the edit and
+    status widgets; attach() starts the jobs once the loop exists.
+    """
+
+    def __init__(self, fieldmgr, completer=None, suggest=None,
+                 defaults=None):
+        self.fieldmgr = fieldmgr
+        self.completer = completer
+        self.suggest = suggest
+        self.defaults = defaults
+        self.edit = None
+        self.status = None
+        self.checker = None
+        # (text, message) for the last completion that left a choice
+        self.matches = (None, '')
+
+    def attach(self, loop):
+        origlink = self.fieldmgr.get_value('origlink')
+        self.checker = BackgroundJob(
+            loop, lambda text: check_target(origlink, text), self._checked)
+        if self.completer is not None:
+            self.completions = BackgroundJob(
+                loop, lambda text: self.completer.complete(origlink, text),
+                self._completed)
+            # after an answer from the index, list the directory too, so
+            # that the next tab also offers its files
+            self.listings = BackgroundJob(loop, self.completer.list)
+        if self.suggest is not None:
+            BackgroundJob(loop, lambda arg: self.suggest(),
+                          self._suggested).submit(None)
+        self.changed(self.edit.get_edit_text())
+
+    def changed(self, text):
+        if self.checker is None:
+            return
+        self.status.set_text(('status', 'checking...'))
+        self.checker.submit(text)
+
+    def _checked(self, text, result):
+        if text != self.edit.get_edit_text():
+            return
+        if isinstance(result, Exception):
+            self.status.set_text(('status-bad', str(result)))
+            return
+        if not text:
+            self.status.set_text(('status-bad', 'no target'))
+            return
+        ok = result['status'] in ('directory', 'file')
+        message = "{}: {}".format(result['status'], result['abspath'])
+        if os.path.isabs(text):
+            message += " (relative: {})".format(result['relpath'])
+        if not ok:
+            if self.fieldmgr.get_value('allowbroken'):
+                message += " - will be a broken link"
+            else:
+                message += " - needs -f to write"
+        if self.matches[0] == text:
+            message += "; " + self.matches[1]
+        self.status.set_text(('status-ok' if ok else 'status-bad', message))
+
+    def complete(self, text):
+        if self.completer is not None:
+            self.status.set_text(('status', 'completing...'))
+            self.completions.submit(text)
+
+    def _completed(self, text, result):
+        if text != self.edit.get_edit_text():
+            return
+        if isinstance(result, Exception):
+            self.status.set_text(('status-bad', str(result)))
+            return
+        newtext, matches, directory, listed = result
+        if not listed:
+            self.listings.submit(directory)
+        if len(matches) != 1:
+            shown = ' '.join(matches[:20])
+            if len(matches) > 20:
+                shown += ' ...'
+            self.matches = (newtext, "{} matches{} {}".format(
+                len(matches), ':' if matches else '', shown))
+        if newtext != text:
+            self.edit.set_edit_text(newtext)
+            self.edit.set_edit_pos(len(newtext))
+        else:
+            self.changed(text)
+
+    def _suggested(self, arg, result):
+        if isinstance(result, Exception):
+            # replace the "(working it out...)" placeholders
+            for key, setter in self.fieldmgr.setters.items():
+                if key.startswith('suggestion-') and not (
+                        self.defaults and key in self.defaults):
+                    setter("(no suggestion: {})".format(result))
+            return
+        for key, value in result.items():
+            if key.startswith('suggestion-'):
+                self.fieldmgr.set_value(key, value)
+                if self.defaults is not None:
+                    self.defaults[key] = value
+
+
 def get_body(fieldmgr):
     """ the body of our form, called from main() """
     # build the list of field widgets
@@ -214,9 +417,18 @@ def get_body(fieldmgr):
     return urwid.AttrWrap(listbox, 'body')
 
 
-def start_main_loop(defaults):
+def start_main_loop(defaults, suggest=None, completer=None):
+    """
+    Run the form.  The target value is checked in the background as it
+    is typed, and tab completes it using completer (a
+    symlink_edit.TargetCompleter), if given.  If suggest is given, the
+    form comes up right away and the suggestion fields are filled in
+    (and added to defaults) when suggest() returns a dict of them.
+    """
     # call our homebrewed object for managing our fields
     fieldmgr = FieldManager(defaults)
+    fieldmgr.assistant = TargetAssistant(fieldmgr, completer, suggest,
+                                         defaults)
 
     #  Our main loop is going to need three things:
     #  1. topmost widget - a "box widget" at the top of the widget hierarchy
@@ -227,6 +439,10 @@ def start_main_loop(defaults):
     header = get_header()
     body = get_body(fieldmgr)
     frame = urwid.Frame(body, header=header)
+    if suggest is not None:
+        for key in fieldmgr.setters:
+            if key.startswith('suggestion-') and key not in defaults:
+                fieldmgr.setters[key]('(working it out...)')
 
     #  2. palette - style information for the UI
     palette = [
@@ -238,6 +454,9 @@ def start_main_loop(defaults):
         ('field', 'white', 'black'),
         ('button', 'light gray', 'black', 'bold'),
         ('buttonfocus', 'white', 'dark blue'),
+        ('status', 'light gray', 'black'),
+        ('status-ok', 'light green', 'black'),
+        ('status-bad', 'light red', 'black'),
     ]
 
     #  3. unhandled_input function - to deal with top level keystrokes
@@ -251,6 +470,7 @@ def start_main_loop(defaults):
 
     # Pass the topmost box widget to the MainLoop to start the show
     urwidloop = urwid.MainLoop(frame, palette, unhandled_input=unhandled)
+    fieldmgr.assistant.attach(urwidloop)
     try:
         urwidloop.run()
     except ExitUrwidForm as inst:
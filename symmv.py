@@ -1,26 +1,245 @@
 #!/usr/bin/env python
 
 import os
-import shutil
 import argparse
+import errno
+import fcntl
+import hashlib
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import fsops
+import pathcache
 
-def symmv(src, dst):
+# from linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+CHUNK = 64 * 1024 * 1024
+
+
+class Progress(object):
+    """ Thread-safe byte counter that prints throughput to stderr """
+
+    def __init__(self, total, quiet=False):
+        self.total = total
+        self.copied = 0
+        self.quiet = quiet
+        self.start = time.monotonic()
+        self.finished = None
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self._lock:
+            self.copied += nbytes
+            now = time.monotonic()
+            if self.quiet or now - self._last < 0.5:
+                return
+            self._last = now
+        self._print('\r')
+
+    def rate(self):
+        elapsed = (self.finished or time.monotonic()) - self.start
+        return self.copied / elapsed if elapsed else 0.0
+
+    def _print(self, end):
+        if not self.quiet:
+            sys.stderr.write("{}{:,.1f}/{:,.1f} MB  {:,.1f} MB/s".format(
+                end, self.copied / 1e6, self.total / 1e6, self.rate() / 1e6))
+            sys.stderr.flush()
+
+    def done(self):
+        self.finished = time.monotonic()
+        self._print('\r')
+        if not self.quiet:
+            sys.stderr.write('\n')
+
+
+def copy_file(src, dst, progress):
+    """
+    Copy one regular file, cheapest method first: a reflink (FICLONE),
+    then copy_file_range(2), then plain shutil.copyfile.
+    """
+    copied = 0
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            progress.add(size)
+            return
+        except OSError:
+            pass
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = fsops.copy_file_range(fsrc.fileno(),
+                                              fdst.fileno(), CHUNK)
+                    if n == 0:
+                        break
+                    copied += n
+                    progress.add(n)
+                return
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.ENOSYS,
+                                     errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+    fsops.copyfile(src, dst)
+    progress.add(size - copied)
+
+
+def copy_tree(src, dst, jobs=4, quiet=False):
+    """
+    Copy src (a file or directory tree) to dst, copying files with a
+    pool of jobs threads.  Symlinks inside the tree are copied as
+    symlinks.  Returns the Progress object for reporting.
+    """
+    files = []
+    total = 0
+    if fsops.isdir(src):
+        for dirpath, dirnames, filenames in os.walk(src):
+            reldir = os.path.relpath(dirpath, src)
+            fsops.makedirs(os.path.join(dst, reldir), exist_ok=True)
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                target = os.path.normpath(os.path.join(dst, reldir, name))
+                st = fsops.lstat(path)
+                if stat.S_ISLNK(st.st_mode):
+                    fsops.symlink(fsops.readlink(path), target)
+                elif stat.S_ISREG(st.st_mode):
+                    files.append((path, target))
+                    total += st.st_size
+    else:
+        files.append((src, dst))
+        total = fsops.getsize(src)
+
+    progress = Progress(total, quiet)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(copy_file, s, d, progress)
+                       for s, d in files]:
+            future.result()
+        for s, d in files:
+            fsops.copystat(s, d)
+    if fsops.isdir(src):
+        for dirpath, dirnames, filenames in os.walk(src, topdown=False):
+            fsops.copystat(dirpath, os.path.join(
+                dst, os.path.relpath(dirpath, src)), follow_symlinks=False)
+    progress.done()
+    return progress
+
+
+def _digest(path):
+    h = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.digest()
+
+
+def verify_copy(src, dst, checksum=False):
+    """
+    Return a list of differences between src and its copy at dst: missing
+    entries, type or size mismatches, symlink values, and (with
+    checksum) file contents.
+    """
+    problems = []
+    pairs = [(src, dst)]
+    if fsops.isdir(src):
+        for dirpath, dirnames, filenames in os.walk(src):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                pairs.append((path, os.path.join(
+                    dst, os.path.relpath(path, src))))
+    for s, d in pairs:
+        try:
+            sst, dst_st = fsops.lstat(s), fsops.lstat(d)
+        except OSError as err:
+            problems.append("{}: {}".format(err.filename, err.strerror))
+            continue
+        if stat.S_IFMT(sst.st_mode) != stat.S_IFMT(dst_st.st_mode):
+            problems.append("{}: file type differs".format(d))
+        elif stat.S_ISLNK(sst.st_mode):
+            if fsops.readlink(s) != fsops.readlink(d):
+                problems.append("{}: symlink value differs".format(d))
+        elif stat.S_ISREG(sst.st_mode):
+            if sst.st_size != dst_st.st_size:
+                problems.append("{}: size differs".format(d))
+            elif checksum and _digest(s) != _digest(d):
+                problems.append("{}: contents differ".format(d))
+    return problems
+
+
+def move(src, dst, jobs=4, checksum=False, quiet=False):
+    """
+    Like shutil.move, but a cross-filesystem move copies with reflinks
+    or copy_file_range and a worker pool, and src is only removed once
+    the copy has been verified.  Returns the final destination path.
+    """
+    realdst = dst
+    if fsops.isdir(dst):
+        realdst = os.path.join(dst, os.path.basename(src))
+    srcdev = fsops.lstat(src).st_dev
+    dstdev = fsops.stat(os.path.dirname(os.path.abspath(realdst))).st_dev
+    if srcdev == dstdev:
+        return fsops.move(src, dst)
+    dst = realdst
+    if fsops.lexists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+
+    try:
+        progress = copy_tree(src, dst, jobs=jobs, quiet=quiet)
+        problems = verify_copy(src, dst, checksum=checksum)
+        if problems:
+            raise OSError(errno.EIO, "copy verification failed: " +
+                          "; ".join(problems[:5]), dst)
+    except BaseException:
+        if fsops.isdir(dst) and not fsops.islink(dst):
+            fsops.rmtree(dst, ignore_errors=True)
+        elif fsops.lexists(dst):
+            fsops.remove(dst)
+        raise
+    if not quiet:
+        sys.stderr.write("copied {:,.1f} MB at {:,.1f} MB/s, verified\n".format(
+            progress.copied / 1e6, progress.rate() / 1e6))
+    if fsops.isdir(src):
+        fsops.rmtree(src)
+    else:
+        fsops.remove(src)
+    return dst
+
+
+def symmv(src, dst, jobs=4, checksum=False, quiet=False):
     src = src.rstrip('/')
-    if os.path.islink(src):
-        linkto = os.readlink(src)
-        os.symlink(linkto, dst)
+    if fsops.islink(src):
+        linkto = pathcache.readlink(src)
+        fsops.symlink(linkto, dst)
+        pathcache.invalidate(dst)
     else:
-        shutil.move(src, dst)
-        if os.path.exists(os.path.join(dst, src)):
-            os.symlink(os.path.join(dst, src), src)
+        move(src, dst, jobs=jobs, checksum=checksum, quiet=quiet)
+        pathcache.invalidate(dst, subtree=True)
+        if fsops.exists(os.path.join(dst, src)):
+            fsops.symlink(os.path.join(dst, src), src)
         else:
-            os.symlink(dst, src)
+            fsops.symlink(dst, src)
+        pathcache.invalidate(src, subtree=True)
 
 
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='mv a file from src to dst, then symlink src to dst')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='copy threads for cross-filesystem moves')
+    parser.add_argument('-c', '--checksum', action='store_true',
+                        help='verify a cross-filesystem copy by content, '
+                        'not just by size')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help="don't report progress")
+    parser.add_argument('--profile', action='store_true',
+                        help='print counts and times of filesystem calls '
+                        'to stderr at exit')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='write a JSON line per filesystem call to FILE')
     parser.add_argument('src', help='original file')
     parser.add_argument('dst', help='place to move')
     return parser.parse_args()
@@ -28,7 +247,9 @@ def parse_arguments():
 
 def main():
     args = parse_arguments()
-    symmv(args.src, args.dst)
+    fsops.start(args.profile, args.trace)
+    symmv(args.src, args.dst, jobs=args.jobs, checksum=args.checksum,
+          quiet=args.quiet)
 
 
 if __name__ == "__main__":